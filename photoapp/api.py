@@ -0,0 +1,269 @@
+import json
+import base64
+import cherrypy
+from datetime import datetime, timedelta
+from decimal import Decimal
+from enum import Enum
+from sqlalchemy import and_, or_, desc
+from photoapp.types import Photo, PhotoSet, Tag, TagItem
+from photoapp.library import THUMB_STYLES
+from photoapp.daemon import photo_auth_filter, get_filters
+from photoapp.exif import exif_filter
+
+
+"""
+Versioned JSON API, mounted next to the html ui. Listings are paginated by an opaque cursor rather than a page number,
+so they stay cheap and stable deep into a large library while photos are being added. Everything is serialized from
+plain column tuples; no ORM objects are loaded.
+"""
+
+SET_FIELDS = {"uuid": PhotoSet.uuid,
+              "date": PhotoSet.date,
+              "date_real": PhotoSet.date_real,
+              "date_offset": PhotoSet.date_offset,
+              "lat": PhotoSet.lat,
+              "lon": PhotoSet.lon,
+              "title": PhotoSet.title,
+              "description": PhotoSet.description,
+              "slug": PhotoSet.slug,
+              "status": PhotoSet.status}
+
+FILE_FIELDS = {"uuid": Photo.uuid,
+               "format": Photo.format,
+               "size": Photo.size,
+               "width": Photo.width,
+               "height": Photo.height,
+               "orientation": Photo.orientation,
+               "hash": Photo.hash,
+               "name": Photo.name,
+               "camera_make": Photo.camera_make,
+               "camera_model": Photo.camera_model,
+               "lens_model": Photo.lens_model,
+               "focal_length": Photo.focal_length,
+               "iso": Photo.iso,
+               "exposure_time": Photo.exposure_time,
+               "f_number": Photo.f_number}
+
+TAG_FIELDS = {"uuid": Tag.uuid,
+              "name": Tag.name,
+              "title": Tag.title,
+              "slug": Tag.slug,
+              "is_album": Tag.is_album}
+
+# fields of a set that aren't columns of the photos table
+RELATED_FIELDS = {"files": FILE_FIELDS, "tags": TAG_FIELDS, "thumbs": None}
+
+LISTING_FIELDS = "uuid,date,title,thumbs"
+BATCH_FIELDS = ",".join(list(SET_FIELDS) + list(RELATED_FIELDS))
+MAX_LIMIT = 500
+# datetime.fromisoformat() is python 3.7+, cursors carry dates in a fixed format instead
+CURSOR_DATE = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def to_json(value):
+    """
+    Convert a column value to something the json encoder accepts
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
+def parse_fields(fields):
+    """
+    Parse a field selection such as "uuid,title,files.uuid,files.format,tags". Naming a related field selects all of
+    its sub-fields.
+    :return: tuple of (set field names, dict of related field name to sub-field names)
+    """
+    columns = []
+    related = {}
+    for field in fields.split(","):
+        field = field.strip()
+        name, _, sub = field.partition(".")
+        if not sub and name in SET_FIELDS:
+            columns.append(name)
+        elif name in RELATED_FIELDS and (not sub or sub in (RELATED_FIELDS[name] or {})):
+            if sub:
+                related.setdefault(name, []).append(sub)
+            else:
+                related[name] = list(RELATED_FIELDS[name] or [])
+        elif field:
+            raise cherrypy.HTTPError(400, "unknown field: {}".format(field))
+    return columns, related
+
+
+def encode_cursor(date, set_id):
+    return base64.urlsafe_b64encode(json.dumps([date.strftime(CURSOR_DATE), set_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        date, set_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.strptime(date, CURSOR_DATE), int(set_id)
+    except (ValueError, TypeError):
+        raise cherrypy.HTTPError(400, "invalid cursor")
+
+
+def serialize(s, rows, columns, related):
+    """
+    Turn (id, *columns) rows of PhotoSets into dicts, fetching selected related fields for all of them at once
+    """
+    ids = [row[0] for row in rows]
+    items = [dict(zip(columns, map(to_json, row[1:len(columns) + 1]))) for row in rows]
+    byid = dict(zip(ids, items))
+
+    if "files" in related:
+        for item in items:
+            item["files"] = []
+        cols = [FILE_FIELDS[f] for f in related["files"]]
+        for row in s.query(Photo.set_id, *cols).filter(Photo.set_id.in_(ids)).order_by(Photo.id):
+            byid[row[0]]["files"].append(dict(zip(related["files"], map(to_json, row[1:]))))
+    if "tags" in related:
+        for item in items:
+            item["tags"] = []
+        cols = [TAG_FIELDS[f] for f in related["tags"]]
+        for row in s.query(TagItem.set_id, *cols).join(Tag).filter(TagItem.set_id.in_(ids)).order_by(Tag.name):
+            byid[row[0]]["tags"].append(dict(zip(related["tags"], map(to_json, row[1:]))))
+    if "thumbs" in related:
+        uuids = dict(s.query(PhotoSet.id, PhotoSet.uuid).filter(PhotoSet.id.in_(ids))) \
+            if "uuid" not in columns else {set_id: item["uuid"] for set_id, item in byid.items()}
+        for set_id, item in byid.items():
+            item["thumbs"] = {style: "/thumb/set/{}/{}.jpg".format(style, uuids[set_id]) for style in THUMB_STYLES}
+    return items
+
+
+class ApiV1(object):
+    """
+    /api/v1 - listings accept `cursor` and `limit` and return {"items": [...], "next": cursor or null}. All endpoints
+    accept `fields`, a comma separated selection of set fields, see parse_fields().
+    """
+    def __init__(self, library):
+        self.library = library
+        self.tag = ApiTagListing(self)
+        self.date = ApiDateListing(self)
+
+    @cherrypy.expose
+    def index(self):
+        return {"version": 1,
+                "endpoints": ["/feed", "/tag/<uuid>", "/date/<YYYY-MM-DD>", "/sets?uuids=<uuid>,..."],
+                "fields": {"set": list(SET_FIELDS) + list(RELATED_FIELDS),
+                           "files": list(FILE_FIELDS),
+                           "tags": list(TAG_FIELDS)}}
+
+    def listing(self, query, cursor=None, limit=50, fields=LISTING_FIELDS, ascending=False):
+        """
+        Return a page of a PhotoSet listing
+        :param query: function taking a session and a query over PhotoSet columns, returning it filtered
+        :param ascending: list oldest first instead of newest first
+        """
+        try:
+            limit = max(1, min(int(limit), MAX_LIMIT))
+        except ValueError:
+            raise cherrypy.HTTPError(400, "invalid limit")
+        columns, related = parse_fields(fields)
+        s = self.library.session()
+        try:
+            q = query(s, photo_auth_filter(s.query(PhotoSet.id, *[SET_FIELDS[f] for f in columns], PhotoSet.date)))
+            if cursor:
+                date, set_id = decode_cursor(cursor)
+                if ascending:
+                    q = q.filter(or_(PhotoSet.date > date, and_(PhotoSet.date == date, PhotoSet.id > set_id)))
+                else:
+                    q = q.filter(or_(PhotoSet.date < date, and_(PhotoSet.date == date, PhotoSet.id < set_id)))
+            order = (PhotoSet.date, PhotoSet.id) if ascending else (desc(PhotoSet.date), desc(PhotoSet.id))
+            rows = q.order_by(*order).limit(limit + 1).all()
+            more = len(rows) > limit
+            rows = rows[:limit]
+            return {"items": serialize(s, rows, columns, related),
+                    "next": encode_cursor(rows[-1][-1], rows[-1][0]) if more else None}
+        finally:
+            s.close()
+
+    @cherrypy.expose
+    def feed(self, cursor=None, limit=50, fields=LISTING_FIELDS, **params):
+        """
+        /api/v1/feed - all photo sets, newest first. Accepts the same exif filters as /feed
+        """
+        filters = get_filters(params)
+        return self.listing(lambda s, q: exif_filter(q, **filters), cursor, limit, fields)
+
+    @cherrypy.expose
+    def sets(self, uuids="", fields=BATCH_FIELDS):
+        """
+        /api/v1/sets - look up many photo sets at once, by comma separated uuids. Sets that don't exist or aren't
+        visible are listed under "missing".
+        """
+        uuids = [uuid for uuid in uuids.split(",") if uuid]
+        if len(uuids) > MAX_LIMIT:
+            raise cherrypy.HTTPError(400, "at most {} sets per request".format(MAX_LIMIT))
+        columns, related = parse_fields(fields)
+        s = self.library.session()
+        try:
+            rows = photo_auth_filter(s.query(PhotoSet.id, *[SET_FIELDS[f] for f in columns], PhotoSet.uuid)). \
+                filter(PhotoSet.uuid.in_(uuids)).all() if uuids else []
+            found = dict(zip((row[-1] for row in rows), serialize(s, rows, columns, related)))
+            return {"sets": [found[uuid] for uuid in uuids if uuid in found],
+                    "missing": [uuid for uuid in uuids if uuid not in found]}
+        finally:
+            s.close()
+
+
+@cherrypy.popargs('uuid')
+class ApiTagListing(object):
+    def __init__(self, api):
+        self.api = api
+
+    @cherrypy.expose
+    def index(self, uuid, cursor=None, limit=50, fields=LISTING_FIELDS, **params):
+        """
+        /api/v1/tag/<uuid> - photo sets under a tag or album, by uuid or slug, newest first
+        """
+        s = self.api.library.session()
+        tag = s.query(Tag.id).filter(or_(Tag.uuid == uuid, Tag.slug == uuid)).first()
+        s.close()
+        if not tag:
+            raise cherrypy.HTTPError(404)
+        filters = get_filters(params)
+        return self.api.listing(lambda s, q: exif_filter(q, **filters).
+                                filter(PhotoSet.id.in_(s.query(TagItem.set_id).filter(TagItem.tag_id == tag[0]))),
+                                cursor, limit, fields)
+
+
+@cherrypy.popargs('date')
+class ApiDateListing(object):
+    def __init__(self, api):
+        self.api = api
+
+    @cherrypy.expose
+    def index(self, date, cursor=None, limit=50, fields=LISTING_FIELDS):
+        """
+        /api/v1/date/<YYYY-MM-DD> - photo sets shot on a day, oldest first
+        """
+        try:
+            start = datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            raise cherrypy.HTTPError(400, "invalid date")
+        return self.api.listing(lambda s, q: q.filter(PhotoSet.date >= start,
+                                                      PhotoSet.date < start + timedelta(days=1)),
+                                cursor, limit, fields, ascending=True)
+
+
+def error(status, message, traceback, version):
+    """
+    Error page handler for the api mount, responding with json instead of html
+    """
+    cherrypy.response.headers["Content-Type"] = "application/json"
+    return json.dumps({"status": status, "message": message})
+
+
+def mount(library, path="/api/v1"):
+    """
+    Mount the api on the cherrypy tree
+    """
+    cherrypy.tree.mount(ApiV1(library), path, {'/': {'tools.trailing_slash.on': False,
+                                                     'tools.json_out.on': True,
+                                                     'error_page.default': error}})
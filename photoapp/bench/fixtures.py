@@ -0,0 +1,122 @@
+import io
+import struct
+from PIL import Image, ImageDraw
+
+
+"""
+Small generated image files for benchmarks. Exif is assembled by hand so fixtures can be written with any Pillow
+version.
+"""
+
+ASCII, SHORT, LONG, RATIONAL = 2, 3, 4, 5
+
+
+def ifd(entries, offset, next_ifd=0):
+    """
+    Encode a little endian tiff IFD located at `offset`, values too large to inline following it
+    :param entries: list of (tag, type, values); ASCII values are a str, others a list
+    """
+    count = len(entries)
+    data_offset = offset + 2 + 12 * count + 4
+    head = struct.pack("<H", count)
+    data = b""
+    for tag, kind, values in sorted(entries):
+        if kind == ASCII:
+            raw = values.encode() + b"\0"
+            n = len(raw)
+        elif kind == SHORT:
+            raw = struct.pack("<{}H".format(len(values)), *values)
+            n = len(values)
+        elif kind == LONG:
+            raw = struct.pack("<{}L".format(len(values)), *values)
+            n = len(values)
+        else:
+            raw = b"".join(struct.pack("<LL", *value) for value in values)
+            n = len(values)
+        if len(raw) <= 4:
+            head += struct.pack("<HHL", tag, kind, n) + raw.ljust(4, b"\0")
+        else:
+            head += struct.pack("<HHLL", tag, kind, n, data_offset + len(data))
+            data += raw + (b"\0" if len(raw) % 2 else b"")
+    return head + struct.pack("<L", next_ifd) + data
+
+
+def rational(value, denominator=1000):
+    return int(round(value * denominator)), denominator
+
+
+def to_dms(value):
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = (value - degrees - minutes / 60) * 3600
+    return [(degrees, 1), (minutes, 1), rational(seconds, 100)]
+
+
+def exif_bytes(date=None, gps=None, make=None, model=None, lens=None, iso=None, focal=None, exposure=None,
+               fnumber=None):
+    """
+    Build an exif block as accepted by Image.save(exif=...)
+    :param gps: tuple of (lat, lon) in decimal degrees
+    :param exposure: exposure time in seconds
+    """
+    main, sub, location = [], [], []
+    datestr = date.strftime("%Y:%m:%d %H:%M:%S") if date else None
+    if make:
+        main.append((0x010f, ASCII, make))
+    if model:
+        main.append((0x0110, ASCII, model))
+    if datestr:
+        main.append((0x0132, ASCII, datestr))
+        sub.append((0x9003, ASCII, datestr))
+    if exposure:
+        sub.append((0x829a, RATIONAL, [(1, int(round(1 / exposure))) if exposure < 1 else rational(exposure)]))
+    if fnumber:
+        sub.append((0x829d, RATIONAL, [rational(fnumber, 10)]))
+    if iso:
+        sub.append((0x8827, SHORT, [iso]))
+    if focal:
+        sub.append((0x920a, RATIONAL, [rational(focal, 10)]))
+    if lens:
+        sub.append((0xa434, ASCII, lens))
+    if gps:
+        location = [(1, ASCII, "N" if gps[0] >= 0 else "S"), (2, RATIONAL, to_dms(gps[0])),
+                    (3, ASCII, "E" if gps[1] >= 0 else "W"), (4, RATIONAL, to_dms(gps[1]))]
+
+    # sizes don't depend on location, so lay the IFDs out back to back using a dry run of each
+    main_size = len(ifd(main + [(0x8769, LONG, [0])] + ([(0x8825, LONG, [0])] if location else []), 0))
+    sub_offset = 8 + main_size
+    gps_offset = sub_offset + len(ifd(sub, 0))
+    main.append((0x8769, LONG, [sub_offset]))
+    if location:
+        main.append((0x8825, LONG, [gps_offset]))
+    tiff = b"II*\0" + struct.pack("<L", 8) + ifd(main, 8) + ifd(sub, sub_offset)
+    if location:
+        tiff += ifd(location, gps_offset)
+    return b"Exif\0\0" + tiff
+
+
+def make_image(size, seed):
+    """
+    Return a PIL image with some structure to it, so it compresses and hashes like a photo more than a flat fill would
+    """
+    width, height = size
+    image = Image.new("RGB", size, ((seed * 67) % 256, (seed * 131) % 256, (seed * 29) % 256))
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        x, y = (seed * 7919 + i * 104729) % width, (seed * 6151 + i * 1299709) % height
+        draw.ellipse([x, y, x + width // 4, y + height // 4],
+                     fill=((seed + i * 40) % 256, (seed * 3 + i * 20) % 256, (i * 60) % 256))
+    return image
+
+
+def jpeg_bytes(size, seed, quality=85, **exif):
+    buf = io.BytesIO()
+    make_image(size, seed).save(buf, "JPEG", quality=quality, exif=exif_bytes(**exif))
+    return buf.getvalue()
+
+
+def png_bytes(size, seed):
+    buf = io.BytesIO()
+    make_image(size, seed).save(buf, "PNG")
+    return buf.getvalue()
@@ -0,0 +1,180 @@
+import os
+import uuid
+import random
+from hashlib import sha256
+from datetime import datetime, timedelta
+from photoapp.types import PhotoSet, Photo, Tag, TagItem, PhotoStatus
+from photoapp.bench.fixtures import jpeg_bytes, png_bytes
+
+
+"""
+Synthetic library generator. Photos are generated the way they are taken: in shooting sessions of a few to a few dozen
+shots seconds apart, spread over a decade with more in recent years, often at one of a handful of frequent locations,
+and tagged per session with a skewed tag popularity. Rows are bulk inserted and file contents are tiny fixtures made
+unique with a trailer, so libraries of a million sets can be built in minutes.
+"""
+
+CAMERAS = [("Canon", "Canon EOS 5D Mark III", ["EF24-105mm f/4L IS USM", "EF50mm f/1.8 STM"]),
+           ("Canon", "Canon EOS R", ["RF35mm F1.8 MACRO IS STM"]),
+           ("Apple", "iPhone X", [None]),
+           ("SONY", "ILCE-7M3", ["FE 24-70mm F2.8 GM", "FE 85mm F1.8"]),
+           ("FUJIFILM", "X-T2", ["XF23mmF2 R WR"])]
+
+WORDS = ["beach", "mountain", "city", "snow", "birthday", "dinner", "hike", "lake", "sunset", "garden", "museum",
+         "concert", "wedding", "road", "trip", "harbor", "forest", "festival", "bridge", "market"]
+
+# frequently visited locations, as (lat, lon)
+PLACES = [(40.7128, -74.0060), (51.5074, -0.1278), (48.8566, 2.3522), (35.6762, 139.6503), (37.7749, -122.4194),
+          (54.2361, -4.5481), (-33.8688, 151.2093), (52.5200, 13.4050), (41.9028, 12.4964), (64.1466, -21.9426)]
+
+TINY = (64, 48)
+
+
+class Generator(object):
+    """
+    :param library: PhotoLibrary to fill, normally empty
+    :param write_files: write a file to the library for every Photo row. Without files, thumbnail and validation
+                        benchmarks have nothing to read.
+    """
+    def __init__(self, library, seed=0, write_files=True, batch=5000):
+        self.library = library
+        self.random = random.Random(seed)
+        self.write_files = write_files
+        self.batch = batch
+        self.fixtures = {"image/jpeg": [jpeg_bytes(TINY, i) for i in range(16)],
+                         "image/png": [png_bytes(TINY, i) for i in range(4)],
+                         "image/x-canon-cr2": [bytes(self.random.getrandbits(8) for _ in range(2048))],
+                         "video/mp4": [bytes(self.random.getrandbits(8) for _ in range(4096))]}
+        self.sets = []
+        self.files = []
+        self.tag_items = []
+        self.set_id = 0
+        self.file_id = 0
+
+    def sessions(self, count):
+        """
+        Yield (start datetime, number of photos, location or None, camera) until `count` photos are accounted for
+        """
+        end = datetime(2019, 1, 1)
+        while count > 0:
+            age = timedelta(days=3650 * (self.random.random() ** 1.5))  # skewed towards recent
+            start = (end - age).replace(microsecond=0)
+            size = min(count, max(1, int(self.random.expovariate(1 / 8))))
+            location = None
+            if self.random.random() < 0.4:
+                lat, lon = self.random.choice(PLACES)
+                location = (round(lat + self.random.gauss(0, 0.05), 6), round(lon + self.random.gauss(0, 0.05), 6))
+            yield start, size, location, self.random.choice(CAMERAS)
+            count -= size
+
+    def add_file(self, set_id, date, fmt, camera=None, ext="jpg"):
+        self.file_id += 1
+        data = self.random.choice(self.fixtures[fmt]) + uuid.uuid4().bytes  # trailer makes the hash unique
+        path = os.path.join(self.library.get_datedir_path(date), "IMG_{:07d}.{}".format(self.file_id, ext))
+        row = {"id": self.file_id, "set_id": set_id, "uuid": str(uuid.uuid4()), "size": len(data),
+               "width": TINY[0], "height": TINY[1], "orientation": 0, "hash": sha256(data).hexdigest(),
+               "path": path, "format": fmt, "camera_make": None, "camera_model": None, "lens_model": None,
+               "focal_length": None, "iso": None, "exposure_time": None, "f_number": None}
+        if camera:
+            make, model, lens = camera
+            row.update(camera_make=make, camera_model=model, lens_model=lens,
+                       focal_length=self.random.choice([24, 35, 50, 85, 105]),
+                       iso=self.random.choice([100, 200, 400, 800, 1600, 3200, 6400]),
+                       exposure_time=1 / self.random.choice([30, 60, 125, 250, 500, 1000]),
+                       f_number=self.random.choice([1.8, 2.8, 4.0, 5.6, 8.0]))
+        self.files.append(row)
+        if self.write_files:
+            fpath = os.path.join(self.library.path, path)
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            with open(fpath, "wb") as f:
+                f.write(data)
+
+    def add_set(self, date, location, camera, tags):
+        self.set_id += 1
+        status = self.random.choices([PhotoStatus.public, PhotoStatus.private, PhotoStatus.hidden], [70, 25, 5])[0]
+        title = " ".join(self.random.sample(WORDS, 2)) if self.random.random() < 0.1 else None
+        lat, lon = location or (0, 0)
+        self.sets.append({"id": self.set_id, "uuid": str(uuid.uuid4()), "date": date, "date_real": date,
+                          "date_offset": 0, "lat": lat, "lon": lon, "title": title, "description": None, "slug": None,
+                          "status": status})
+        kind = self.random.random()
+        if kind < 0.05:
+            self.add_file(self.set_id, date, "video/mp4", ext="mp4")
+        elif kind < 0.15:
+            self.add_file(self.set_id, date, "image/png", ext="png")
+        else:
+            self.add_file(self.set_id, date, "image/jpeg", camera=(camera[0], camera[1], self.random.choice(camera[2])))
+            if kind > 0.75:
+                self.add_file(self.set_id, date, "image/x-canon-cr2", ext="cr2")
+        for tag_id in tags:
+            self.tag_items.append({"tag_id": tag_id, "set_id": self.set_id, "order": 0})
+
+    def flush(self, force=False):
+        """
+        Write out pending rows once a batch has built up
+        :return: True if rows were written
+        """
+        if len(self.sets) < self.batch and not force:
+            return False
+        with self.library.engine.begin() as c:
+            if self.sets:
+                c.execute(PhotoSet.__table__.insert(), self.sets)
+            if self.files:
+                c.execute(Photo.__table__.insert(), self.files)
+            if self.tag_items:
+                c.execute(TagItem.__table__.insert(), self.tag_items)
+        self.sets, self.files, self.tag_items = [], [], []
+        return True
+
+    def generate(self, count, progress=None):
+        """
+        Add `count` PhotoSets to the library
+        :param progress: called with the number of sets generated so far
+        """
+        ntags = max(10, count // 500)
+        weights = [1 / (i + 1) for i in range(ntags)]  # zipf-like popularity
+        s = self.library.session()
+        tags = [Tag(name="tag{}".format(i), title="Tag {} {}".format(i, self.random.choice(WORDS)),
+                    slug="tag{}".format(i), is_album=i % 10 == 0) for i in range(ntags)]
+        s.add_all(tags)
+        s.commit()
+        tag_ids = [tag.id for tag in tags]
+        s.close()
+
+        for start, size, location, camera in self.sessions(count):
+            tags = set(self.random.choices(tag_ids, weights, k=self.random.randint(1, 3))) \
+                if self.random.random() < 0.4 else set()
+            date = start
+            for _ in range(size):
+                self.add_set(date, location, camera, tags)
+                date += timedelta(seconds=int(self.random.expovariate(1 / 60)) + 1)
+            if self.flush() and progress:
+                progress(self.set_id)
+        self.flush(force=True)
+        return self.set_id, self.file_id
+
+
+def write_imports(directory, count, size=(2000, 1500), seed=0):
+    """
+    Write `count` camera-like files, full size JPEGs with exif and the occasional PNG screenshot, ready to be imported
+    :return: list of paths written
+    """
+    rand = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    start = datetime(2019, 6, 1, 9)
+    for i in range(count):
+        if i % 10 == 9:
+            path = os.path.join(directory, "Screenshot_{:05d}.png".format(i))
+            data = png_bytes(size, i)
+        else:
+            make, model, lenses = rand.choice(CAMERAS)
+            lat, lon = rand.choice(PLACES)
+            path = os.path.join(directory, "IMG_{:05d}.jpg".format(i))
+            data = jpeg_bytes(size, i, date=start + timedelta(minutes=i), gps=(lat, lon) if i % 2 else None,
+                              make=make, model=model, lens=rand.choice(lenses), iso=rand.choice([100, 400, 1600]),
+                              focal=rand.choice([24, 50, 85]), exposure=1 / 250, fnumber=2.8)
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
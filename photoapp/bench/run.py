@@ -0,0 +1,276 @@
+import io
+import os
+import sys
+import json
+import shutil
+import base64
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import cherrypy
+from time import time
+from datetime import datetime
+from cherrypy.lib import httputil
+from sqlalchemy import func
+from photoapp.library import PhotoLibrary, THUMB_STYLES
+from photoapp.types import Photo, PhotoSet, Tag, TagItem
+from photoapp.daemon import PhotosWeb, APPROOT, app_config
+from photoapp.ingest import batch_ingest
+from photoapp.validate import validate_all
+from photoapp.users import create_user
+from photoapp.bench.generate import Generator, write_imports
+
+
+"""
+End to end benchmarks over synthetic libraries. Each run builds a fresh library of the requested size and times the
+core paths: importing, thumbnailing, serving pages and verifying. Results are printed as json so runs from different
+commits can be diffed or plotted.
+"""
+
+
+def percentile(ordered, q):
+    """
+    Linearly interpolated percentile of a sorted, non-empty list
+    :param q: fraction between 0 and 1
+    """
+    pos = (len(ordered) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def summarize(durations):
+    """
+    Return stats in milliseconds for a list of durations in seconds
+    """
+    ordered = sorted(durations)
+    if not ordered:
+        return {"n": 0}
+    return {"n": len(ordered),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+            "p50_ms": round(percentile(ordered, 0.5) * 1000, 3),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def timed(func, *args, **kwargs):
+    start = time()
+    func(*args, **kwargs)
+    return time() - start
+
+
+class Client(object):
+    """
+    Make requests against a cherrypy app in-process, without a server or sockets. Keeps cookies between requests.
+    """
+    def __init__(self, script_name=""):
+        self.script_name = script_name
+        self.cookies = {}
+
+    def request(self, path, qs="", method="GET", headers=None):
+        app = cherrypy.tree.apps[self.script_name]
+        request, response = app.get_serving(httputil.Host("127.0.0.1", 8080, ""),
+                                            httputil.Host("127.0.0.1", 50000, ""), "http", "HTTP/1.1")
+        headers = dict(headers or {}, Host="localhost")
+        if self.cookies:
+            headers["Cookie"] = "; ".join("{}={}".format(k, v) for k, v in self.cookies.items())
+        try:
+            request.run(method, path, qs, "HTTP/1.1", list(headers.items()), io.BytesIO(b""))
+            body = b"".join(response.body)
+            for name, morsel in response.cookie.items():
+                self.cookies[name] = morsel.value
+            return int(response.status.split(" ")[0]), body
+        finally:
+            app.release_serving()
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silence the progress output of the tools being timed
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def bench_ingest(library, workdir, count):
+    paths = write_imports(os.path.join(workdir, "import"), count)
+    with quiet():
+        elapsed = timed(batch_ingest, library, paths)
+    return {"files": count, "seconds": round(elapsed, 3), "files_per_second": round(count / elapsed, 2)}
+
+
+def time_thumbs(library, photos, style):
+    """
+    Time making a thumbnail of each photo. Failed thumbnails are counted as errors rather than timed.
+    """
+    durations = []
+    errors = 0
+    for photo in photos:
+        start = time()
+        if library.make_thumb(photo, style):
+            durations.append(time() - start)
+        else:
+            errors += 1
+    return dict(summarize(durations), errors=errors)
+
+
+def bench_thumbs(library, samples):
+    """
+    Time generating each thumbnail style from the most recently imported full size jpegs, then serving them from cache
+    """
+    s = library.session()
+    photos = s.query(Photo).filter(Photo.format == "image/jpeg").order_by(Photo.id.desc()).limit(samples).all()
+    results = {}
+    for style in THUMB_STYLES:
+        shutil.rmtree(os.path.join(library.cache_path, "thumbs", style), ignore_errors=True)
+        results[style] = {"miss": time_thumbs(library, photos, style),
+                          "hit": time_thumbs(library, photos, style)}
+    s.close()
+    return results
+
+
+def bench_handlers(library, repeat, seed=0):
+    """
+    Time the main pages through the full cherrypy request cycle, logged in so every photo is visible
+    """
+    rand = random.Random(seed)
+    web = PhotosWeb(library, os.path.join(APPROOT, "templates"))
+    cherrypy.tree.apps.clear()
+    cherrypy.tree.mount(web, "/", app_config(web, os.path.join(APPROOT, "styles/dist")))
+    cherrypy.config.update({"tools.sessions.on": True, "tools.sessions.locking": "explicit",
+                            "log.screen": False, "environment": "embedded"})
+    with quiet():
+        create_user(library, "bench", "bench")
+    client = Client()
+    status, body = client.request("/login", headers={"Authorization": "Basic " +
+                                                     base64.b64encode(b"bench:bench").decode()})
+    assert status == 302, "login failed: {}".format(status)
+
+    s = library.session()
+    total = s.query(func.count(PhotoSet.id)).scalar()
+    popular_tag = s.query(Tag.slug).join(TagItem).group_by(Tag.id).order_by(func.count(TagItem.id).desc()).first()[0]
+    busy_day = s.query(func.strftime("%Y-%m-%d", PhotoSet.date).label("day")).group_by("day"). \
+        order_by(func.count(PhotoSet.id).desc()).first()[0]
+    s.close()
+    pages = {"feed": ("/feed", lambda: ""),
+             "feed_deep": ("/feed", lambda: "page={}".format(rand.randrange(max(1, total // 25)))),
+             "tag": ("/tag/" + popular_tag, lambda: ""),
+             "date": ("/date/" + busy_day, lambda: ""),
+             "dates": ("/date", lambda: ""),
+             "map": ("/map", lambda: ""),
+             "stats": ("/stats", lambda: "")}
+    results = {}
+    for name, (path, qs) in pages.items():
+        durations = []
+        for i in range(repeat):
+            start = time()
+            status, body = client.request(path, qs())
+            durations.append(time() - start)
+            assert status == 200, "{} returned {}".format(path, status)
+        results[name] = summarize(durations)
+    cherrypy.tree.apps.clear()
+    return results
+
+
+def bench_validate(library, workers):
+    with quiet():
+        elapsed = timed(validate_all, library, workers=workers)
+    s = library.session()
+    files, size = s.query(func.count(Photo.id), func.sum(Photo.size)).first()
+    s.close()
+    return {"files": files, "seconds": round(elapsed, 3), "files_per_second": round(files / elapsed, 2),
+            "mb_per_second": round((size or 0) / elapsed / 1024 / 1024, 2)}
+
+
+def run(sets, workdir, args):
+    """
+    Build a library of `sets` photo sets under workdir and benchmark it
+    """
+    library = PhotoLibrary(os.path.join(workdir, "photos.db"), os.path.join(workdir, "library"),
+                           os.path.join(workdir, "cache"))
+    os.makedirs(library.path, exist_ok=True)
+    result = {"sets": sets}
+
+    def progress(done):
+        print("  generated: {} / {}\r".format(done, sets), end='', file=sys.stderr)
+
+    start = time()
+    generated, files = Generator(library, seed=args.seed, write_files=not args.no_files).generate(sets, progress)
+    print(file=sys.stderr)
+    result["generate"] = {"sets": generated, "files": files, "seconds": round(time() - start, 3)}
+
+    if "ingest" not in args.skip:
+        print("benchmarking ingest", file=sys.stderr)
+        result["ingest"] = bench_ingest(library, workdir, args.ingest)
+    if "thumbs" not in args.skip:
+        print("benchmarking thumbnails", file=sys.stderr)
+        result["thumbs"] = bench_thumbs(library, args.thumb_samples)
+    if "handlers" not in args.skip:
+        print("benchmarking handlers", file=sys.stderr)
+        result["handlers"] = bench_handlers(library, args.requests, seed=args.seed)
+    if "validate" not in args.skip and not args.no_files:
+        print("benchmarking validation", file=sys.stderr)
+        result["validate"] = bench_validate(library, args.workers)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "-C", APPROOT, "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Photo library benchmarks. Prints results as json.")
+    parser.add_argument("-n", "--sets", type=int, nargs="+", default=[10000],
+                        help="library sizes to benchmark, e.g. 10000 100000 1000000")
+    parser.add_argument("-w", "--workdir", help="where libraries are built, defaults to a temporary directory")
+    parser.add_argument("--keep", action="store_true", help="don't delete the generated libraries")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-files", action="store_true",
+                        help="only generate database rows, not library files. Skips validation.")
+    parser.add_argument("--ingest", type=int, default=100, help="full size files to import")
+    parser.add_argument("--thumb-samples", type=int, default=20, help="photos thumbnailed per style")
+    parser.add_argument("--requests", type=int, default=20, help="requests made per page")
+    parser.add_argument("-j", "--workers", type=int, help="validation processes, defaults to the cpu count")
+    parser.add_argument("--skip", nargs="+", default=[], choices=["ingest", "thumbs", "handlers", "validate"])
+    args = parser.parse_args()
+
+    report = {"revision": git_revision(),
+              "started": datetime.now().isoformat(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpus": os.cpu_count(),
+              "runs": []}
+    root = args.workdir or tempfile.mkdtemp(prefix="photobench-")
+    try:
+        for sets in args.sets:
+            print("benchmarking {} sets".format(sets), file=sys.stderr)
+            workdir = os.path.join(root, str(sets))
+            if os.path.exists(workdir):
+                shutil.rmtree(workdir)
+            os.makedirs(workdir)
+            report["runs"].append(run(sets, workdir, args))
+            if not args.keep:
+                shutil.rmtree(workdir)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
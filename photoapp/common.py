@@ -1,7 +1,22 @@
 import hashlib
+from collections import deque
 
 
 def pwhash(password):
     h = hashlib.sha256()
     h.update(password.encode("UTF-8"))
     return h.hexdigest()
+
+
+def bounded_map(executor, func, iterable, window):
+    """
+    Like executor.map(), but keeps at most `window` calls submitted ahead of the consumer, so memory stays bounded on
+    very long inputs. Results are yielded in input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
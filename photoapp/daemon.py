@@ -2,12 +2,20 @@ import os
 import cherrypy
 import logging
 from datetime import datetime, timedelta
-from photoapp.library import PhotoLibrary
+from photoapp.library import PhotoLibrary, THUMB_STYLES
 from photoapp.types import Photo, PhotoSet, Tag, TagItem, PhotoStatus, User
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
 from sqlalchemy import desc
 from sqlalchemy import func, and_, or_
 from photoapp.common import pwhash
+from photoapp.thumbnail import get_backend
+from photoapp.search import search_filter
+from photoapp.exif import exif_filter, FILTERS
+from photoapp.tagging import add_tag, remove_tag, set_tag_status
+from photoapp.streaming import StreamLimiter, RetryLater, serve_original, serve_zip
+from photoapp import metrics
+from photoapp.profiling import SlowRequestProfiler
+from photoapp.thumbqueue import ThumbnailQueue
 import math
 from urllib.parse import urlparse
 
@@ -55,20 +63,64 @@ def photo_auth_filter(query):
     return query.filter(PhotoSet.status == PhotoStatus.public) if not auth() else query
 
 
+def get_filters(params):
+    """
+    Pick the exif filters, see photoapp.exif.exif_filter(), out of a dict of request parameters. Numeric filters are
+    parsed here so a malformed value is a bad request rather than an error deep in the query.
+    """
+    filters = {k: v for k, v in params.items() if k in FILTERS and v}
+    for k, parse in (("iso_gte", int), ("iso_lte", int), ("focal_gte", float), ("focal_lte", float)):
+        if k in filters:
+            try:
+                filters[k] = parse(filters[k])
+            except (TypeError, ValueError):
+                raise cherrypy.HTTPError(400, "invalid {}".format(k))
+    return filters
+
+
 def slugify(words):
     return ''.join(letter for letter in '-'.join(words.lower().split())
                    if ('a' <= letter <= 'z') or ('0' <= letter <= '9') or letter == '-')
 
 
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """
+    Jinja's file bytecode cache, writing each file under a temporary name and renaming it into place, so workers
+    sharing the cache never load a half written file
+    """
+    def dump_bytecode(self, bucket):
+        path = self._get_cache_filename(bucket)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            bucket.write_bytecode(f)
+        os.replace(tmp, path)
+
+
 class PhotosWeb(object):
-    def __init__(self, library, template_dir):
+    def __init__(self, library, template_dir, streams=None, accel_prefix=None, profiler=None, thumbs=None,
+                 debug=False):
+        """
+        :param thumbs: ThumbnailQueue to generate thumbnails in the background, instead of in request threads
+        :param debug: reload templates when they change on disk. Otherwise every template is compiled up front.
+        """
         self.library = library
+        self.thumbs = thumbs
+        self.profiler = profiler
+        self.streams = streams or StreamLimiter()
+        self.accel_prefix = accel_prefix
+        bytecode_dir = os.path.join(library.cache_path, "templates")
+        os.makedirs(bytecode_dir, exist_ok=True)
         self.tpl = Environment(loader=FileSystemLoader(template_dir),
-                               autoescape=select_autoescape(['html', 'xml']))
+                               autoescape=select_autoescape(['html', 'xml']),
+                               bytecode_cache=AtomicBytecodeCache(bytecode_dir),
+                               auto_reload=debug)
         self.tpl.filters.update(mime2ext=mime2ext,
                                 basename=os.path.basename,
                                 ceil=math.ceil,
                                 statusstr=lambda x: str(x).split(".")[-1])
+        if not debug:
+            for name in self.tpl.list_templates():
+                self.tpl.get_template(name)
 
         self.thumb = ThumbnailView(self)
         self.photo = PhotoView(self)
@@ -123,16 +175,18 @@ class PhotosWeb(object):
         raise cherrypy.HTTPRedirect('feed', 302)
 
     @cherrypy.expose
-    def feed(self, page=0, pgsize=25):
+    def feed(self, page=0, pgsize=25, **params):
         """
-        /feed - main photo feed - show photos sorted by date, newest first
+        /feed - main photo feed - show photos sorted by date, newest first. Accepts exif filters such as ?camera=
         """
         s = self.session()
         page, pgsize = int(page), int(pgsize)
-        total_sets = photo_auth_filter(s.query(func.count(PhotoSet.id))).first()[0]
-        images = photo_auth_filter(s.query(PhotoSet)).order_by(PhotoSet.date.desc()). \
+        filters = get_filters(params)
+        total_sets = exif_filter(photo_auth_filter(s.query(func.count(PhotoSet.id))), **filters).first()[0]
+        images = exif_filter(photo_auth_filter(s.query(PhotoSet)), **filters).order_by(PhotoSet.date.desc()). \
             offset(pgsize * page).limit(pgsize).all()
-        yield self.render("feed.html", images=[i for i in images], page=page, pgsize=int(pgsize), total_sets=total_sets)
+        yield self.render("feed.html", images=[i for i in images], page=page, pgsize=int(pgsize), total_sets=total_sets,
+                          filters=filters, pager_args=filters)
 
     @cherrypy.expose
     def stats(self):
@@ -145,7 +199,29 @@ class PhotosWeb(object):
                                            func.strftime('%m', PhotoSet.date).label('month'))). \
             group_by('year', 'month').order_by(desc('year'), desc('month')).all()
         tsize = photo_auth_filter(s.query(func.sum(Photo.size)).join(PhotoSet)).scalar()  # pragma: manual auth
-        yield self.render("monthly.html", images=images, tsize=tsize)
+        yield self.render("monthly.html", images=images, tsize=tsize,
+                          streams=self.streams.stats() if auth() else None)
+
+    @cherrypy.expose
+    def metrics(self):
+        """
+        /metrics - server metrics in the Prometheus text format
+        """
+        for stat, value in self.streams.stats().items():
+            metrics.STREAMS.set(value, stat=stat)
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return metrics.render()
+
+    @cherrypy.expose
+    @require_auth
+    def slow(self, n=20):
+        """
+        /slow - list the slowest recent requests captured by the profiler, see --profile-slow-ms
+        """
+        if not self.profiler:
+            raise cherrypy.HTTPError(404)
+        yield self.render("slow.html", requests=self.profiler.slowest(int(n)),
+                          threshold=int(self.profiler.threshold * 1000))
 
     @cherrypy.expose
     def map(self, i=None, a=None, zoom=3):
@@ -162,6 +238,21 @@ class PhotosWeb(object):
             query = query.filter(PhotoSet.uuid == i)
         yield self.render("map.html", images=query.all(), zoom=int(zoom))
 
+    @cherrypy.expose
+    def search(self, q="", page=0):
+        """
+        /search - find photos by words in their title, description or tags, best matches first
+        """
+        s = self.session()
+        page, pgsize = int(page), 100
+        images, total_sets = [], 0
+        if q.strip():
+            query = search_filter(photo_auth_filter(s.query(PhotoSet)), q)
+            total_sets = query.order_by(None).count()
+            images = query.offset(page * pgsize).limit(pgsize).all()
+        yield self.render("search.html", images=images, total_items=total_sets, pgsize=pgsize, page=page,
+                          query=q, pager_args={"q": q})
+
     @cherrypy.expose
     @require_auth
     def create_tags(self, fromdate=None, uuid=None, tag=None, newtag=None, remove=None):
@@ -192,8 +283,7 @@ class PhotosWeb(object):
         if remove:
             rmtag = s.query(Tag).filter(Tag.uuid == remove).first()
             photoq, _ = get_photos()
-            for photo in photoq:
-                s.query(TagItem).filter(TagItem.tag_id == rmtag.id, TagItem.set_id == photo.id).delete()
+            remove_tag(s, rmtag.id, photoq.with_entities(PhotoSet.id))
             s.commit()
 
         if newtag:
@@ -204,10 +294,7 @@ class PhotosWeb(object):
 
         if tag:  # Create the tag on all the photos
             tag = s.query(Tag).filter(Tag.uuid == tag).first()
-            for photo in photos.all():
-                if 0 == s.query(func.count(TagItem.id)).filter(TagItem.tag_id == tag.id,
-                                                               TagItem.set_id == photo.id).scalar():
-                    s.add(TagItem(tag_id=tag.id, set_id=photo.id))
+            add_tag(s, tag.id, photos.with_entities(PhotoSet.id))
             s.commit()
 
         alltags = s.query(Tag).order_by(Tag.name).all()
@@ -284,6 +371,8 @@ class ThumbnailView(object):
     @cherrypy.expose
     def index(self, item_type, thumb_size, uuid):
         uuid = uuid.split(".")[0]
+        if thumb_size not in THUMB_STYLES:
+            raise cherrypy.HTTPError(404)
         s = self.master.session()
 
         query = photo_auth_filter(s.query(Photo).join(PhotoSet))
@@ -294,9 +383,9 @@ class ThumbnailView(object):
 
         assert query
 
-        # prefer making thumbs from jpeg to avoid loading large raws
-        # jk we can't load raws anyway
+        # prefer making thumbs from jpeg to avoid loading large raws or videos
         first = None
+        usable = None
         best = None
         for photo in query.all():
             if first is None:
@@ -304,17 +393,37 @@ class ThumbnailView(object):
             if photo.format == "image/jpeg":
                 best = photo
                 break
-        thumb_from = best or first
-        print(repr(thumb_from))
+            if usable is None and get_backend(photo.format):
+                usable = photo
+        thumb_from = best or usable or first
         if not thumb_from:
             raise cherrypy.HTTPError(404)
-        # TODO some lock around calls to this based on uuid
-        thumb_path = self.master.library.make_thumb(thumb_from, thumb_size)
+        if self.master.thumbs:
+            thumb_path = self.queue_thumb(thumb_from, thumb_size)
+        else:
+            # TODO some lock around calls to this based on uuid
+            thumb_path = self.master.library.make_thumb(thumb_from, thumb_size)
         if thumb_path:
             return cherrypy.lib.static.serve_file(thumb_path, "image/jpeg")
         else:
             return cherrypy.lib.static.serve_file(os.path.join(APPROOT, "styles/dist/unknown.svg"), "image/svg+xml")
 
+    def queue_thumb(self, photo, style):
+        """
+        Return the path to the thumbnail if it exists or can't be made, otherwise queue it to be generated and respond
+        503 with a Retry-After. Images in pages retry on their own, see page.html. Browsing to a thumbnail directly
+        waits for it instead.
+        """
+        library = self.master.library
+        path = library.cached_thumb(photo, style)
+        if path or not library.can_thumb(photo, style):
+            return path
+        done = self.master.thumbs.submit(photo, style)
+        if done and "text/html" in cherrypy.request.headers.get("Accept", "") and done.wait(30):
+            return library.cached_thumb(photo, style)
+        cherrypy.response.headers['Cache-Control'] = 'no-store'
+        raise RetryLater(1, "Thumbnail is being generated")
+
 
 @cherrypy.popargs('item_type', 'uuid')
 class DownloadView(object):
@@ -329,18 +438,57 @@ class DownloadView(object):
         uuid = uuid.split(".")[0]
         s = self.master.session()
 
-        query = None if item_type == "set" \
-            else photo_auth_filter(s.query(Photo)).filter(Photo.uuid == uuid) if item_type == "one" \
-            else None  # TODO set download query
+        if item_type in ("set", "tag", "album"):
+            return self.archive(s, item_type, uuid)
+
+        query = photo_auth_filter(s.query(Photo)).filter(Photo.uuid == uuid) if item_type == "one" else None
 
-        item = query.first()
+        item = query.first() if query else None
         if not item:
             raise cherrypy.HTTPError(404)
-        extra = {}
-        if not preview:
-            extra.update(disposition="attachement", name=os.path.basename(item.path))
-        return cherrypy.lib.static.serve_file(os.path.abspath(os.path.join(self.master.library.path, item.path)),
-                                              content_type=item.format, **extra)
+        return serve_original(self.master.streams, self.master.library.path, item.path, item.format,
+                              download_name=None if preview else item.name or os.path.basename(item.path),
+                              accel_prefix=self.master.accel_prefix)
+
+    def archive(self, s, item_type, uuid):
+        """
+        Stream every file under a photo set, or every file in every set under a tag, as a zip
+        """
+        query = photo_auth_filter(s.query(Photo.path, Photo.hash, Photo.name, Photo.size, PhotoSet.date).join(PhotoSet))
+        if item_type == "set":
+            owner = photo_auth_filter(s.query(PhotoSet)).filter(or_(PhotoSet.uuid == uuid,
+                                                                    PhotoSet.slug == uuid)).first()
+            if owner:
+                query = query.filter(PhotoSet.id == owner.id)
+        else:
+            owner = s.query(Tag).filter(or_(Tag.uuid == uuid, Tag.slug == uuid)).first()
+            if owner:
+                query = query.join(TagItem).filter(TagItem.tag_id == owner.id)
+        if not owner:
+            raise cherrypy.HTTPError(404)
+
+        # sets are flat, tags keep the library's date directories so names can't collide
+        entries = []
+        names = set()
+        for path, fhash, name, size, date in query.order_by(PhotoSet.date, Photo.path).all():
+            if item_type == "set":
+                arcname = name or os.path.basename(path)
+            elif name:  # content addressed, named like the file's link in the date tree
+                arcname, renamed = self.master.library.view_paths(fhash, name, date)
+                arcname = renamed if arcname in names else arcname
+            else:
+                arcname = path
+            try:
+                size = os.path.getsize(os.path.join(self.master.library.path, path))
+            except OSError:  # missing from disk, leave it out rather than break the archive partway
+                continue
+            names.add(arcname)
+            entries.append((path, arcname, size, date))
+        name = "{}.zip".format(owner.slug or owner.uuid)
+        s.close()
+        if not entries:
+            raise cherrypy.HTTPError(404)
+        return serve_zip(self.master.streams, self.master.library.path, entries, name)
 
 
 @cherrypy.popargs('uuid')
@@ -380,7 +528,12 @@ class PhotoView(object):
             photo.title = title
             photo.description = description
             photo.slug = slugify(title) or None
-            photo.date_offset = int(offset) if offset else 0
+            s.commit()
+            # also recomputes the date and moves the files if the date directory changes
+            moved, skipped = self.master.library.set_offset(s, s.query(PhotoSet.id).filter(PhotoSet.id == photo.id),
+                                                            int(offset) if offset else 0)
+            for path in skipped:
+                cherrypy.log.error("could not move {} to its new date directory".format(path))
         s.commit()
         raise cherrypy.HTTPRedirect('/photo/{}'.format(photo.slug or photo.uuid), 302)
 
@@ -401,29 +554,34 @@ class TagView(object):
         self.master = master
 
     @cherrypy.expose
-    def index(self, uuid, page=0):
+    def index(self, uuid, page=0, **params):
         page = int(page)
         pgsize = 100
         s = self.master.session()
+        filters = get_filters(params)
 
         if uuid == "untagged":
-            numphotos = photo_auth_filter(s.query(func.count(PhotoSet.id))). \
+            numphotos = exif_filter(photo_auth_filter(s.query(func.count(PhotoSet.id))), **filters). \
                 filter(~PhotoSet.id.in_(s.query(TagItem.set_id))).scalar()
-            photos = photo_auth_filter(s.query(PhotoSet)).filter(~PhotoSet.id.in_(s.query(TagItem.set_id))).\
+            photos = exif_filter(photo_auth_filter(s.query(PhotoSet)), **filters). \
+                filter(~PhotoSet.id.in_(s.query(TagItem.set_id))).\
                 offset(page * pgsize). \
                 limit(pgsize).all()
-            yield self.master.render("untagged.html", images=photos, total_items=numphotos, pgsize=pgsize, page=page)
+            yield self.master.render("untagged.html", images=photos, total_items=numphotos, pgsize=pgsize, page=page,
+                                     filters=filters, pager_args=filters)
         else:
             tag = s.query(Tag).filter(or_(Tag.uuid == uuid, Tag.slug == uuid)).first()
-            numphotos = photo_auth_filter(s.query(func.count(Tag.id)).join(TagItem).join(PhotoSet)). \
+            numphotos = exif_filter(photo_auth_filter(s.query(func.count(Tag.id)).join(TagItem).join(PhotoSet)),
+                                    **filters). \
                 filter(Tag.id == tag.id).scalar()
-            photos = photo_auth_filter(s.query(PhotoSet)).join(TagItem).join(Tag). \
+            photos = exif_filter(photo_auth_filter(s.query(PhotoSet)).join(TagItem).join(Tag), **filters). \
                 filter(Tag.id == tag.id). \
                 order_by(PhotoSet.date.desc()). \
                 offset(page * pgsize). \
                 limit(pgsize).all()
             yield self.master.render("album.html", tag=tag, images=photos,
-                                     total_items=numphotos, pgsize=pgsize, page=page)
+                                     total_items=numphotos, pgsize=pgsize, page=page,
+                                     filters=filters, pager_args=filters)
 
     @cherrypy.expose
     @require_auth
@@ -448,13 +606,9 @@ class TagView(object):
             s.commit()
             raise cherrypy.HTTPRedirect('/', 302)
         elif op == "Make all public":
-            # TODO smarter query
-            for photo in s.query(PhotoSet).join(TagItem).join(Tag).filter(Tag.id == tag.id).all():
-                photo.status = PhotoStatus.public
+            set_tag_status(s, tag.id, PhotoStatus.public)
         elif op == "Make all private":
-            # TODO smarter query
-            for photo in s.query(PhotoSet).join(TagItem).join(Tag).filter(Tag.id == tag.id).all():
-                photo.status = PhotoStatus.private
+            set_tag_status(s, tag.id, PhotoStatus.private)
         elif op == "Save":
             tag.title = title
             tag.description = description
@@ -472,9 +626,28 @@ class TagView(object):
         yield self.master.render("tag_edit.html", tag=tag)
 
 
+def app_config(web, static_dir):
+    """
+    Return the cherrypy app config to mount the PhotosWeb instance `web` with
+    """
+    def validate_password(realm, username, password):
+        s = web.library.session()
+        if s.query(User).filter(User.name == username, User.password == pwhash(password)).first():
+            return True
+        return False
+
+    return {'/': {'tools.trailing_slash.on': False,
+                  'error_page.403': web.error,
+                  'error_page.404': web.error},
+            '/static': {"tools.staticdir.on": True,
+                        "tools.staticdir.dir": static_dir},
+            '/login': {'tools.auth_basic.on': True,
+                       'tools.auth_basic.realm': 'photolib',
+                       'tools.auth_basic.checkpassword': validate_password}}
+
+
 def main():
     import argparse
-    import signal
 
     parser = argparse.ArgumentParser(description="Photod photo server")
 
@@ -482,34 +655,76 @@ def main():
     parser.add_argument('-l', '--library', default="./library", help="library path")
     parser.add_argument('-c', '--cache', default="./cache", help="cache path")
     parser.add_argument('-s', '--database', default="./photos.db", help="path to persistent sqlite database")
+    parser.add_argument('--max-streams', default=8, type=int,
+                        help="max concurrent large downloads, each holds a request thread. Split between --workers, "
+                             "with at least one per worker")
+    parser.add_argument('--accel-redirect', help="hand file transfers off to nginx via X-Accel-Redirect under this "
+                                                 "internal location prefix")
+    parser.add_argument('--thumb-workers', type=int, help="generate thumbnails in this many background threads, "
+                                                           "answering cache misses with a 503 and Retry-After "
+                                                           "instead of blocking the request. Split between "
+                                                           "--workers, with at least one per worker")
+    parser.add_argument('--profile-slow-ms', type=int, help="sample request stacks and save profiles of requests "
+                                                             "slower than this, listed at /slow")
+    parser.add_argument('--profile-dir', help="where slow request profiles are saved, defaults to <cache>/profiles. "
+                                              "The newest 200 are kept.")
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help="serve from this many processes sharing the port, with sessions stored on disk")
     parser.add_argument('--debug', action="store_true", help="enable development options")
 
     args = parser.parse_args()
+    if args.workers > 1 and args.debug:
+        parser.error("--workers can't be used with --debug, autoreload restarts a single process")
 
     logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING,
                         format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
 
-    library = PhotoLibrary(args.database, args.library, args.cache)
+    if args.workers > 1:
+        from photoapp import prefork
+        # set the database up once here, rather than have every worker race to create and upgrade the schema
+        PhotoLibrary(args.database, args.library, args.cache).engine.dispose()
+        prefork.listen('0.0.0.0', args.port)
+        prefork.supervise(args.workers, lambda: serve(args, setup=False))
+    else:
+        serve(args)
+
+
+def serve(args, setup=True):
+    """
+    Run the server in this process until it receives SIGINT or SIGTERM
+    :param setup: create and upgrade the database schema, see PhotoLibrary
+    """
+    import signal
+    from photoapp import api
+
+    library = PhotoLibrary(args.database, args.library, args.cache, setup=setup)
+    metrics.instrument_engine(library.engine)
+
+    profiler = None
+    if args.profile_slow_ms is not None:
+        profiler = SlowRequestProfiler(args.profile_slow_ms / 1000,
+                                       args.profile_dir or os.path.join(args.cache, "profiles"))
+        metrics.STATEMENT_HOOKS.append(profiler.record_statement)
+        cherrypy.tools.profile_slow = profiler.tool()
+        cherrypy.config.update({'tools.profile_slow.on': True})
 
     tpl_dir = os.path.join(APPROOT, "templates") if not args.debug else "templates"
 
-    web = PhotosWeb(library, tpl_dir)
+    # limits are per process, give each worker its share
+    max_streams = max(1, args.max_streams // args.workers)
+    thumb_workers = max(1, args.thumb_workers // args.workers) if args.thumb_workers else None
 
-    def validate_password(realm, username, password):
-        s = library.session()
-        if s.query(User).filter(User.name == username, User.password == pwhash(password)).first():
-            return True
-        return False
+    web = PhotosWeb(library, tpl_dir, streams=StreamLimiter(max_streams=max_streams),
+                    accel_prefix=args.accel_redirect, profiler=profiler,
+                    thumbs=ThumbnailQueue(library, workers=thumb_workers) if thumb_workers else None,
+                    debug=args.debug)
 
-    cherrypy.tree.mount(web, '/', {'/': {'tools.trailing_slash.on': False,
-                                         'error_page.403': web.error,
-                                         'error_page.404': web.error},
-                                   '/static': {"tools.staticdir.on": True,
-                                               "tools.staticdir.dir": os.path.join(APPROOT, "styles/dist")
-                                               if not args.debug else os.path.abspath("styles/dist")},
-                                   '/login': {'tools.auth_basic.on': True,
-                                              'tools.auth_basic.realm': 'photolib',
-                                              'tools.auth_basic.checkpassword': validate_password}})
+    cherrypy.tree.mount(web, '/', app_config(web, os.path.join(APPROOT, "styles/dist")
+                                             if not args.debug else os.path.abspath("styles/dist")))
+    api.mount(library)
+    # notice changes made by other workers and imports
+    cherrypy.process.plugins.Monitor(cherrypy.engine, library.check_changes, frequency=1,
+                                     name="library changes").subscribe()
 
     cherrypy.config.update({
         'tools.sessions.on': True,
@@ -521,8 +736,15 @@ def main():
         'server.socket_host': '0.0.0.0',
         'server.show_tracebacks': True,
         'log.screen': False,
+        'tools.metrics.on': True,
         'engine.autoreload.on': args.debug
     })
+    if args.workers > 1:
+        # sessions in memory would only be known to the worker that created them
+        os.makedirs(os.path.join(args.cache, "sessions"), exist_ok=True)
+        from photoapp.prefork import FileSession
+        cherrypy.config.update({'tools.sessions.storage_class': FileSession,
+                                'tools.sessions.storage_path': os.path.join(args.cache, "sessions")})
 
     def signal_handler(signum, stack):
         logging.critical('Got sig {}, exiting...'.format(signum))
@@ -1,26 +1,68 @@
 import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import or_
 from photoapp.library import PhotoLibrary
-from photoapp.types import PhotoSet
-from datetime import timedelta
+from photoapp.types import PhotoSet, Photo, Tag, TagItem
 
 
-def set_offset(library, uuid, offset):
+def select_sets(s, uuid=None, start=None, end=None, tag=None, camera=None):
+    """
+    Build a query of PhotoSet ids matching all the given criteria
+    :param start: sets recorded on or after this datetime
+    :param end: sets recorded before this datetime
+    :param tag: sets under the tag or album with this uuid, slug or name
+    :param camera: sets containing a file shot on this camera model
+    """
+    query = s.query(PhotoSet.id)
+    if uuid:
+        query = query.filter(PhotoSet.uuid == uuid)
+    # ranges apply to the date the camera recorded, so re-running a correction selects the same sets
+    if start:
+        query = query.filter(PhotoSet.date_real >= start)
+    if end:
+        query = query.filter(PhotoSet.date_real < end)
+    if tag:
+        query = query.filter(PhotoSet.id.in_(s.query(TagItem.set_id).join(Tag).
+                                             filter(or_(Tag.uuid == tag, Tag.slug == tag, Tag.name == tag))))
+    if camera:
+        query = query.filter(PhotoSet.files.any(Photo.camera_model == camera))
+    return query
+
+
+def set_offset(library, offset, **criteria):
+    """
+    Apply a date offset to every PhotoSet matching the criteria, see select_sets()
+    """
     s = library.session()
-    photo = s.query(PhotoSet).filter(PhotoSet.uuid == uuid).first()
-    print("Original date: {}".format(photo.date))
-    photo.date_offset = offset
-    photo.date = photo.date_real + timedelta(minutes=offset)
-    print("New date:      {}".format(photo.date))
-    s.commit()
+    ids = select_sets(s, **criteria)
+    count = ids.count()
+    print("Setting offset of {} photos to {} minutes".format(count, offset))
+    moved, skipped = library.set_offset(s, ids, offset)
+    print("Moved {} files to new date directories".format(moved))
+    for path in skipped:
+        print("Could not move {}".format(path))
+    s.close()
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Photo date offset manipulation tool")
-    parser.add_argument("-u", "--uuid", required=True, help="photo uuid")
+    parser = argparse.ArgumentParser(description="Photo date offset manipulation tool. Selection options combine to "
+                                                 "narrow down which photos are changed")
     parser.add_argument("-o", "--offset", required=True, type=int, help="offset in minutes")
+    parser.add_argument("-u", "--uuid", help="photo uuid")
+    parser.add_argument("--from", dest="start", type=parse_date, help="photos recorded on or after this YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", type=parse_date, help="photos recorded on or before this YYYY-MM-DD")
+    parser.add_argument("-t", "--tag", help="photos under this tag or album (uuid, slug or name)")
+    parser.add_argument("-c", "--camera", help="photos taken with this camera model, as recorded in exif")
     args = parser.parse_args()
+    if not any([args.uuid, args.start, args.end, args.tag, args.camera]):
+        parser.error("at least one of --uuid, --from, --to, --tag or --camera is required")
     library = PhotoLibrary("photos.db", "./library/", "./cache/")
-    set_offset(library, args.uuid, args.offset)
+    set_offset(library, args.offset, uuid=args.uuid, start=args.start,
+               end=args.end + timedelta(days=1) if args.end else None, tag=args.tag, camera=args.camera)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+import os
+import argparse
+import traceback
+import numpy as np
+from PIL import Image
+from collections import defaultdict
+from itertools import combinations
+from photoapp.library import PhotoLibrary
+from photoapp.types import Photo, PhotoSet
+from photoapp.thumbnail import get_backend
+
+
+"""
+Near-duplicate detection. Each image gets a 64 bit difference hash (dHash) at ingest; two photos whose hashes differ by
+only a few bits are very likely the same shot re-encoded, resized or re-exported.
+
+Searching uses multi-index hashing: with a max distance of k, if the hash is split into k + 1 bands then by the
+pigeonhole principle any two hashes within distance k agree exactly on at least one band. Splitting into k + 2 bands
+means they agree on at least two, so each pair of bands is used as a sort key and only hashes sharing a key are
+compared, using a vectorized popcount over the packed hashes.
+"""
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def get_phash(image):
+    """
+    Compute the 64 bit dHash of a PIL image: shrink to 9x8 greyscale and record whether each pixel is brighter than
+    its right-hand neighbour.
+    """
+    image.draft("L", (64, 64))  # lets the jpeg decoder skip most of the work
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return to_signed(value)
+
+
+def to_signed(value):
+    """
+    sqlite integers are signed 64 bit, shift hashes with the top bit set into range
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def popcount(values):
+    """
+    Count set bits in each element of a uint64 array
+    """
+    return POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def find_pairs(hashes, distance=4):
+    """
+    Find all pairs of hashes within the given hamming distance
+    :param hashes: numpy uint64 array of distinct hashes. exact duplicates would all land in the same buckets and be
+        compared pairwise on every pass; deduplicate them first, as find_clusters() does
+    :param distance: max number of differing bits, up to 6. the buckets get too coarse to be useful beyond that
+    :return: numpy array of shape (n, 2) holding (i, j) index pairs into hashes, i < j
+    """
+    if not 0 <= distance <= 6:
+        raise Exception("Distance must be between 0 and 6")
+    bands = distance + 2
+    widths = [64 // bands + (1 if band < 64 % bands else 0) for band in range(bands)]
+    masks = []
+    for band, width in enumerate(widths):
+        masks.append(((1 << width) - 1) << sum(widths[0:band]))
+    found = []
+    for first, second in combinations(range(bands), 2):
+        keys = hashes & np.uint64(masks[first] | masks[second])
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        # walk each run of equal keys pairwise by comparing every position with the one `step` places later. the set
+        # of positions still inside a run only shrinks, so total work is proportional to the candidate pairs
+        starts = np.arange(len(keys) - 1)
+        step = 1
+        while len(starts):
+            starts = starts[keys[starts] == keys[starts + step]]
+            a, b = order[starts], order[starts + step]
+            close = popcount(hashes[a] ^ hashes[b]) <= distance
+            found.append(np.stack([np.minimum(a, b)[close], np.maximum(a, b)[close]], axis=1))
+            step += 1
+            starts = starts[starts + step < len(keys)]
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+    found = np.unique(np.concatenate(found) @ np.array([len(hashes), 1]))  # pairs show up once per matching combo
+    return np.stack([found // len(hashes), found % len(hashes)], axis=1)
+
+
+def find_clusters(hashes, distance=4):
+    """
+    Group hashes into clusters of near-duplicates
+    :param hashes: numpy uint64 array
+    :return: list of lists of indexes into hashes
+    """
+    values, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    # exact duplicates are linked to the first occurrence of their value, near ones via the first of each value
+    rep = first[inverse.ravel()]
+    exact = np.stack([rep, np.arange(len(hashes))], axis=1)[rep != np.arange(len(hashes))]
+    near = first[find_pairs(values, distance)]
+    return cluster(len(hashes), np.concatenate([exact, near]))
+
+
+def cluster(count, pairs):
+    """
+    Union-find the given index pairs into clusters
+    :param pairs: numpy array of shape (n, 2)
+    :return: list of lists of indexes, only clusters of 2 or more members are returned
+    """
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in pairs.tolist():
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    groups = defaultdict(list)
+    for i in np.unique(pairs).tolist():
+        groups[find(i)].append(i)
+    return [sorted(group) for group in groups.values()]
+
+
+def find_dupes(library, distance=4):
+    """
+    Return clusters of near-duplicate files as lists of (set uuid, file path) tuples
+    """
+    s = library.session()
+    rows = s.query(Photo.phash, PhotoSet.uuid, Photo.path).join(PhotoSet). \
+        filter(Photo.phash != None).order_by(Photo.id).all()  # NOQA
+    hashes = np.array([row[0] for row in rows], dtype=np.int64).view(np.uint64)
+    clusters = []
+    for group in find_clusters(hashes, distance):
+        members = [(rows[i][1], rows[i][2]) for i in group]
+        if len({uuid for uuid, path in members}) > 1:  # files within one set are expected to match
+            clusters.append(members)
+    return clusters
+
+
+def backfill(library):
+    """
+    Compute perceptual hashes for files imported before they were recorded at ingest
+    """
+    s = library.session()
+    todo = s.query(Photo).filter(Photo.phash == None, Photo.format.like("image/%")).all()  # NOQA
+    for done, photo in enumerate(todo, start=1):
+        loader = get_backend(photo.format)
+        if loader:
+            try:
+                photo.phash = get_phash(loader(os.path.join(library.path, photo.path)))
+            except Exception:
+                traceback.print_exc()
+        if done % 500 == 0:
+            s.commit()
+        print("  complete: {} / {} \r".format(done, len(todo)), end='')
+    s.commit()
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Near-duplicate photo finder")
+    parser.add_argument("-d", "--distance", default=4, type=int, help="max differing bits of two duplicates (0-6)")
+    parser.add_argument("--backfill", action="store_true", help="hash files imported without a perceptual hash")
+    args = parser.parse_args()
+
+    library = PhotoLibrary("photos.db", "./library/", "./cache/")
+    if args.backfill:
+        backfill(library)
+
+    clusters = find_dupes(library, args.distance)
+    for members in clusters:
+        for uuid, path in members:
+            print("{}\t{}".format(uuid, path))
+        print()
+    print("{} clusters of near-duplicates".format(len(clusters)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import os
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ExifTags
+from sqlalchemy import select, and_, bindparam
+from photoapp.library import PhotoLibrary
+from photoapp.types import Photo, PhotoSet
+from photoapp.common import bounded_map
+
+
+"""
+Camera and exposure details read from exif and stored on Photo rows, so the library can be filtered on them using the
+column indexes rather than re-reading files.
+"""
+
+# formats ingest reads exif from
+EXIF_FORMATS = ["image/jpeg", "image/png", "image/gif"]
+
+# Photo fields this module populates
+FIELDS = ["camera_make", "camera_model", "lens_model", "focal_length", "iso", "exposure_time", "f_number"]
+
+# criteria accepted by exif_filter()
+FILTERS = ["camera", "lens", "iso_gte", "iso_lte", "focal_gte", "focal_lte"]
+
+
+def to_float(value):
+    """
+    Convert an exif rational to a float. Depending on the Pillow version these are IFDRational objects or
+    (numerator, denominator) tuples.
+    """
+    if isinstance(value, tuple):
+        if len(value) != 2 or not value[1]:
+            return None
+        return value[0] / value[1]
+    try:
+        value = float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return value if value == value else None  # 0/0 rationals come out as nan
+
+
+def to_text(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "ignore")
+    if isinstance(value, str):
+        return value.strip("\x00 ") or None
+    return None
+
+
+def read_fields(exif):
+    """
+    Normalize a dict of named exif tags into a dict of Photo fields. Missing or unreadable tags are left out.
+    """
+    iso = exif.get("ISOSpeedRatings")
+    if isinstance(iso, tuple):  # some cameras record one value per sensitivity type
+        iso = iso[0] if iso else None
+    fields = {"camera_make": to_text(exif.get("Make")),
+              "camera_model": to_text(exif.get("Model")),
+              "lens_model": to_text(exif.get("LensModel")),
+              "focal_length": to_float(exif.get("FocalLength")),
+              "iso": int(iso) if isinstance(iso, int) and iso > 0 else None,
+              "exposure_time": to_float(exif.get("ExposureTime")),
+              "f_number": to_float(exif.get("FNumber"))}
+    return {k: v for k, v in fields.items() if v is not None}
+
+
+def get_named_exif(img):
+    """
+    Return the exif tags of an open PIL image as a dict keyed by tag name
+    """
+    exif_data = img._getexif() if hasattr(img, "_getexif") else None
+    if not exif_data:
+        return {}
+    return {ExifTags.TAGS[k]: v for k, v in exif_data.items() if k in ExifTags.TAGS}
+
+
+def exif_filter(query, camera=None, lens=None, iso_gte=None, iso_lte=None, focal_gte=None, focal_lte=None):
+    """
+    Sqlalchemy helper: filter the given PhotoSet query to sets containing a file matching all of the given criteria.
+    The criteria select from the indexed files columns and the sets are matched by id.
+    """
+    conditions = []
+    if camera:
+        conditions.append(Photo.camera_model == camera)
+    if lens:
+        conditions.append(Photo.lens_model == lens)
+    if iso_gte:
+        conditions.append(Photo.iso >= int(iso_gte))
+    if iso_lte:
+        conditions.append(Photo.iso <= int(iso_lte))
+    if focal_gte:
+        conditions.append(Photo.focal_length >= float(focal_gte))
+    if focal_lte:
+        conditions.append(Photo.focal_length <= float(focal_lte))
+    if not conditions:
+        return query
+    return query.filter(PhotoSet.id.in_(select([Photo.set_id]).where(and_(*conditions))))
+
+
+def read_file(args):
+    """
+    Read the exif fields of one file. Runs in a worker process.
+    :return: tuple of (id, fields)
+    """
+    library_path, fid, path = args
+    try:
+        return fid, read_fields(get_named_exif(Image.open(os.path.join(library_path, path))))
+    except Exception:
+        traceback.print_exc()
+        return fid, {}
+
+
+def iter_missing(library, chunk=1000):
+    """
+    Yield (id, path) of image files with no exposure details recorded. Files that genuinely lack exif stay in this
+    set, so they are re-read on every backfill.
+    """
+    s = library.session()
+    after = 0
+    while True:
+        rows = s.query(Photo.id, Photo.path). \
+            filter(Photo.id > after, Photo.format.in_(EXIF_FORMATS), Photo.camera_model == None,  # NOQA
+                   Photo.iso == None, Photo.focal_length == None, Photo.exposure_time == None). \
+            order_by(Photo.id).limit(chunk).all()
+        if not rows:
+            break
+        yield from rows
+        after = rows[-1][0]
+    s.close()
+
+
+def backfill(library, workers=None, batch=500):
+    """
+    Read exif fields for files imported before they were recorded at ingest, across a process pool
+    :param workers: number of processes, defaults to the cpu count
+    """
+    workers = workers or os.cpu_count()
+    update = Photo.__table__.update().where(Photo.id == bindparam("_id")). \
+        values({field: bindparam(field) for field in FIELDS})
+    results = []
+
+    def flush():
+        if results:
+            library.engine.execute(update, results)
+            results.clear()
+
+    done = 0
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = ((library.path, fid, path) for fid, path in iter_missing(library))
+        for done, (fid, fields) in enumerate(bounded_map(pool, read_file, jobs, workers * 4), start=1):
+            if fields:
+                results.append(dict({field: fields.get(field) for field in FIELDS}, _id=fid))
+            if len(results) >= batch:
+                flush()
+            if done % 100 == 0:
+                print("  complete: {}\r".format(done), end='')
+        flush()
+    print("\n{} files read".format(done))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exif detail tool")
+    parser.add_argument("--backfill", action="store_true", help="read details of files imported without them")
+    parser.add_argument("-j", "--workers", type=int, help="processes, defaults to the cpu count")
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.error("nothing to do")
+    library = PhotoLibrary("photos.db", "./library/", "./cache/")
+    backfill(library, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,20 @@
 from datetime import datetime
-from PIL import Image, ExifTags
+from time import time, sleep
+from PIL import Image
 from decimal import Decimal
 from hashlib import sha256
 import os
 import magic
 from photoapp.types import Photo, PhotoSet
+from photoapp.exif import get_named_exif, read_fields
 
 
 def get_jpg_info(fpath):
     """
     Given the path to a jpg, return a dict describing it
     """
-    date, gps, dimensions, orientation = get_exif_data(fpath)
+    img = Image.open(fpath)
+    date, gps, dimensions, orientation, details = get_exif_data(fpath, img)
 
     if date is None:
         import pdb
@@ -23,9 +26,15 @@ def get_jpg_info(fpath):
     dimensions = dimensions or (0, 0)
     mime = magic.from_file(fpath, mime=True)
     size = os.path.getsize(fpath)
+    from photoapp.dupes import get_phash  # not at the top, dupes brings in numpy
+    try:
+        phash = get_phash(img)
+    except OSError:  # truncated or corrupt image data - import it anyway, dupes.py --backfill can retry
+        phash = None
 
     photo = Photo(hash=get_hash(fpath), path=fpath, format=mime, size=size,
-                  width=dimensions[0], height=dimensions[1], orientation=orientation)
+                  width=dimensions[0], height=dimensions[1], orientation=orientation,
+                  phash=phash, **details)
     return PhotoSet(date=date, date_real=date, lat=lat, lon=lon, files=[photo])
 
 
@@ -33,70 +42,80 @@ def get_mtime(fpath):
     return datetime.fromtimestamp(os.stat(fpath).st_mtime)
 
 
-def get_hash(path):
+def get_hash(path, rate=None):
+    """
+    Return the sha256 of the file at path
+    :param rate: optional limit on read speed, in bytes per second
+    """
     hasher = sha256()
+    start = time()
+    total = 0
     with open(path, 'rb') as f:
         while True:
             piece = f.read(1024 * 256)
             if not piece:
                 break
             hasher.update(piece)
+            total += len(piece)
+            if rate:
+                ahead = total / rate - (time() - start)
+                if ahead > 0:
+                    sleep(ahead)
     return hasher.hexdigest()
 
 
-def get_exif_data(path):
+def get_exif_data(path, img=None):
     """
-    Return a (datetime, (decimal, decimal), (width, height), rotation) tuple describing the photo's exif date and gps coordinates
+    Return a (datetime, (decimal, decimal), (width, height), rotation, details) tuple describing the photo's exif date
+    and gps coordinates. details is a dict of Photo fields describing the camera and exposure, see photoapp.exif
+    :param img: the file already opened with PIL, if it has been. Only its headers are read.
     """
-    img = Image.open(path)
+    img = img or Image.open(path)
 
     datestr = None
     gpsinfo = None
     dateinfo = None
     orientationinfo = 0
     sizeinfo = (img.width, img.height)
+    detailinfo = {}
 
     if img.format in ["JPEG", "PNG", "GIF"]:
-        if hasattr(img, "_getexif"):
-            exif_data = img._getexif()
-            if exif_data:
-                exif = {
-                    ExifTags.TAGS[k]: v
-                    for k, v in exif_data.items()
-                    if k in ExifTags.TAGS
-                }
-                acceptable = ["DateTime", "DateTimeOriginal", "DateTimeDigitized"]
-                for key in acceptable:
-                    if key in exif:
-                        datestr = exif[key]
-                        continue
-
-                if datestr:
-                    if not datestr.startswith("0000"):  # Weed out some known bad cases
-                        try:
-                            dateinfo = datetime.strptime(datestr, "%Y:%m:%d %H:%M:%S")
-                        except ValueError:
-                            dateinfo = datetime.strptime(datestr, "%Y:%m:%d:%H:%M:%S")
-
-                orien = exif.get("Orientation")
-                if orien:
-                    orientationinfo = {0: 0, 8: 1, 3: 2, 6: 3}.get(int(orien), 0)
-
-                gps = exif.get("GPSInfo")
-                if gps and 1 in gps and 2 in gps and 3 in gps and 4 in gps:
-                    # see https://gis.stackexchange.com/a/273402
-                    gps_y = round(hms_to_decimal(rational64u_to_hms(gps[2])), 8)
-                    gps_x = round(hms_to_decimal(rational64u_to_hms(gps[4])), 8)
-                    if gps[1] == 'S':
-                        gps_y *= -1
-                    if gps[3] == 'W':
-                        gps_x *= -1
-                    gpsinfo = (gps_y, gps_x)
+        exif = get_named_exif(img)
+        if exif:
+            acceptable = ["DateTime", "DateTimeOriginal", "DateTimeDigitized"]
+            for key in acceptable:
+                if key in exif:
+                    datestr = exif[key]
+                    continue
+
+            if datestr:
+                if not datestr.startswith("0000"):  # Weed out some known bad cases
+                    try:
+                        dateinfo = datetime.strptime(datestr, "%Y:%m:%d %H:%M:%S")
+                    except ValueError:
+                        dateinfo = datetime.strptime(datestr, "%Y:%m:%d:%H:%M:%S")
+
+            detailinfo = read_fields(exif)
+
+            orien = exif.get("Orientation")
+            if orien:
+                orientationinfo = {0: 0, 8: 1, 3: 2, 6: 3}.get(int(orien), 0)
+
+            gps = exif.get("GPSInfo")
+            if gps and 1 in gps and 2 in gps and 3 in gps and 4 in gps:
+                # see https://gis.stackexchange.com/a/273402
+                gps_y = round(hms_to_decimal(rational64u_to_hms(gps[2])), 8)
+                gps_x = round(hms_to_decimal(rational64u_to_hms(gps[4])), 8)
+                if gps[1] == 'S':
+                    gps_y *= -1
+                if gps[3] == 'W':
+                    gps_x *= -1
+                gpsinfo = (gps_y, gps_x)
 
     if dateinfo is None:
         dateinfo = get_mtime(path)
 
-    return dateinfo, gpsinfo, sizeinfo, orientationinfo
+    return dateinfo, gpsinfo, sizeinfo, orientationinfo, detailinfo
 
 
 def rational64u_to_hms(values):
@@ -1,3 +1,4 @@
+import sys
 import magic
 import argparse
 import traceback
@@ -30,13 +31,20 @@ def pprogress(done, total=None):
     print("  complete: {}{}\r".format(done, " / {} ".format(total) if total else ''), end='')
 
 
-def batch_ingest(library, files):
+def batch_ingest(library, files, verbose=True):
+    """
+    Import a list of files. RAWs are grouped with the JPEG of the same name anywhere in the list.
+    :param verbose: print each step and progress, otherwise only problems are printed
+    :return: number of photo sets added
+    """
+    log = print if verbose else lambda *args, **kwargs: None
+    progress = pprogress if verbose else lambda *args: None
     # group by extension
     byext = {k: [] for k in known_extensions}
 
     total = len(files)
-    print("processing {} items".format(total))
-    print("Pre-sorting files")
+    log("processing {} items".format(total))
+    log("Pre-sorting files")
     for item in files:
         if not os.path.isfile(item):
             print("Skipping due to not a file: {}".format(item))
@@ -53,14 +61,14 @@ def batch_ingest(library, files):
             continue
         byext[extension.lower()].append(item)
 
-    print("Scanning images")
+    log("Scanning images")
     photos = []
     # process regular images first.
     for item in chain(*[byext[ext] for ext in regular_images]):
         photos.append(get_jpg_info(item))
-        pprogress(len(photos), total)
+        progress(len(photos), total)
 
-    print("\nScanning RAWs")
+    log("\nScanning RAWs")
     # process raws
     done = len(photos)
     for item in chain(*[byext[ext] for ext in files_raw]):
@@ -75,7 +83,7 @@ def batch_ingest(library, files):
                     foundmatch = True
                     photo.files.append(itemmeta)
                     done += 1
-                    pprogress(done, total)
+                    progress(done, total)
                     break
             if foundmatch:
                 break
@@ -83,10 +91,10 @@ def batch_ingest(library, files):
             mtime = get_mtime(item)
             photos.append(PhotoSet(date=mtime, date_real=mtime, lat=0, lon=0, files=[itemmeta]))
             done += 1
-            pprogress(done, total)
+            progress(done, total)
         # TODO prune any xmp without an associated regular image or cr2
 
-    print("\nScanning other files")
+    log("\nScanning other files")
     # process all other formats
     for item in chain(*[byext[ext] for ext in files_video]):
         itemmeta = Photo(hash=get_hash(item), path=item, size=os.path.getsize(item),
@@ -94,20 +102,86 @@ def batch_ingest(library, files):
         mtime = get_mtime(item)
         photos.append(PhotoSet(date=mtime, date_real=mtime, lat=0, lon=0, files=[itemmeta]))
         done += 1
-        pprogress(done, total)
+        progress(done, total)
 
-    print("\nUpdating database")
+    log("\nUpdating database")
     done = 0
     total = len(photos)
     for photoset in photos:
         try:
             library.add_photoset(photoset)
-            pprogress(done, total)
+            progress(done, total)
             done += 1
         except:
             traceback.print_exc()
             pass
-    print("\nUpdate complete")
+    log("\nUpdate complete")
+    return done
+
+
+def walk_files(root):
+    """
+    Yield the files under root a directory at a time, as lists of paths
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if filenames:
+            yield [os.path.join(dirpath, name) for name in filenames]
+
+
+def read_files(lines):
+    """
+    Yield paths listed one per line as lists of paths in the same directory. Lines from one directory should be
+    together, as `find` prints them: a RAW is only grouped with a JPEG listed in the same run of lines.
+    """
+    group = []
+    for line in lines:
+        path = line.rstrip("\n")
+        if not path:
+            continue
+        if group and os.path.dirname(path) != os.path.dirname(group[-1]):
+            yield group
+            group = []
+        group.append(path)
+    if group:
+        yield group
+
+
+def file_stem(path):
+    return os.path.basename(path).rsplit(".", 1)[0].lower()
+
+
+def windows(groups, size):
+    """
+    Split lists of paths from one directory into lists of about `size` paths. Cuts fall between files whose names
+    differ in more than the extension, so a RAW always lands in the same window as its JPEG.
+    """
+    for group in groups:
+        group.sort(key=lambda path: os.path.basename(path).lower())
+        window = []
+        for path in group:
+            if len(window) >= size and file_stem(path) != file_stem(window[-1]):
+                yield window
+                window = []
+            window.append(path)
+        if window:
+            yield window
+
+
+def stream_ingest(library, groups, size=1000):
+    """
+    Import files a window at a time, so memory use stays flat however many files there are
+    :param groups: iterable of lists of paths from one directory, see walk_files() and read_files()
+    :return: number of photo sets added
+    """
+    added = 0
+    files = 0
+    for window in windows(groups, size):
+        added += batch_ingest(library, window, verbose=False)
+        files += len(window)
+        print("  files: {} sets added: {}\r".format(files, added), end='')
+    print()
+    return added
 
 
 def special_magic(fpath):
@@ -119,12 +193,30 @@ def special_magic(fpath):
 
 def main():
     parser = argparse.ArgumentParser(description="Library ingestion tool")
-    parser.add_argument("files", nargs="+")
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("-r", "--recursive", nargs="+", default=[], metavar="DIR",
+                        help="import every file under these directories")
+    parser.add_argument("--from-file", metavar="LIST",
+                        help="import the paths listed one per line in this file, or - for stdin")
+    parser.add_argument("--window", type=int, default=1000,
+                        help="files scanned and committed at a time with --recursive or --from-file")
     args = parser.parse_args()
+    if not (args.files or args.recursive or args.from_file):
+        parser.error("no files given")
+
+    library = PhotoLibrary("photos.db", "./library/", "./cache/")
 
-    library = PhotoLibrary("photos.db", "./library/")
+    if not (args.recursive or args.from_file):
+        batch_ingest(library, args.files)
+        return
 
-    batch_ingest(library, args.files)
+    groups = chain(read_files(args.files), *[walk_files(root) for root in args.recursive])
+    if args.from_file:
+        with (sys.stdin if args.from_file == "-" else open(args.from_file)) as lines:
+            added = stream_ingest(library, chain(groups, read_files(lines)), args.window)
+    else:
+        added = stream_ingest(library, groups, args.window)
+    print("{} sets added".format(added))
 
 
 if __name__ == '__main__':
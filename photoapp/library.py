@@ -2,7 +2,7 @@ import os
 import sys
 import traceback
 from time import time
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, func, event
 from sqlalchemy.pool import StaticPool
 from sqlalchemy.orm import sessionmaker
 from photoapp.types import Base, Photo, PhotoSet  # need to be loaded for orm setup
@@ -10,112 +10,341 @@ from sqlalchemy.exc import IntegrityError
 from collections import defaultdict
 from multiprocessing import Process
 from PIL import Image, ImageOps
+from photoapp.thumbnail import get_backend
+from photoapp.search import create_index as create_search_index
+from photoapp.metrics import THUMB_REQUESTS, THUMB_SECONDS
+
+
+# style tuples: max x, max y, rotate ok)
+# rotate ok means x and y maxes can be swapped if it fits the image's aspect ratio better
+THUMB_STYLES = {"tiny": (80, 80, False),
+                "small": (100, 100, False),
+                "feed": (250, 250, False),
+                "preview": (1024, 768, True),
+                "big": (2048, 1536, True)}
+
+# originals of content addressed libraries are kept here, named by hash
+STORE_DIR = "objects"
 
 
 class PhotoLibrary(object):
-    def __init__(self, db_path, lib_path, cache_path):
+    def __init__(self, db_path, lib_path, cache_path, content_addressed=None, setup=True):
+        """
+        :param content_addressed: store originals by hash under objects/, with the date tree made of links to them.
+                                  Detected from the presence of the objects directory by default.
+        :param setup: create and upgrade the database schema. Pass False when another process already has.
+        """
         self.path = lib_path
+        self.content_addressed = os.path.isdir(os.path.join(lib_path, STORE_DIR)) \
+            if content_addressed is None else content_addressed
         self.cache_path = cache_path
         self.engine = create_engine('sqlite:///{}'.format(db_path),
                                     connect_args={'check_same_thread': False}, poolclass=StaticPool)
-        Base.metadata.create_all(self.engine)
+        if setup:
+            Base.metadata.create_all(self.engine)
+            self.upgrade_schema()
+            create_search_index(self.engine)
         self.session = sessionmaker()
         self.session.configure(bind=self.engine)
         self._failed_thumbs_cache = defaultdict(dict)
+        self._data_version = None
+        event.listen(self.engine, "commit", lambda conn: self.clear_caches())
+
+    def upgrade_schema(self):
+        """
+        Bring tables created by older versions up to date. create_all() only creates missing tables, so columns and
+        indexes added to existing tables since are created here. New columns must be nullable.
+        """
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    self.engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                        table.name, column.name, column.type.compile(self.engine.dialect)))
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+
+    def clear_caches(self):
+        """
+        Forget what this process remembers about the library, after the library has been changed
+        """
+        self._failed_thumbs_cache.clear()
+
+    def check_changes(self):
+        """
+        Clear caches if another process - another daemon worker, or an import - has written to the database since the
+        last call. sqlite's data_version only moves for commits made on other connections, commits made through this
+        library clear the caches as they happen.
+        """
+        version = self.engine.execute("PRAGMA data_version").scalar()
+        if self._data_version is not None and version != self._data_version:
+            self.clear_caches()
+        self._data_version = version
 
     def add_photoset(self, photoset):
         """
         Commit a populated photoset object to the library. The paths in the photoset's file list entries will be updated
         as the file is moved to the library path.
+        In a content addressed library, a file whose hash is already stored raises FileExistsError.
         """
 
         # Create target directory
         path = os.path.join(self.path, self.get_datedir_path(photoset.date))
-        os.makedirs(path, exist_ok=True)
+        if not self.content_addressed:
+            os.makedirs(path, exist_ok=True)
 
         moves = []  # Track files moved. If the sql transaction files, we'll undo these
 
-        for file in photoset.files:
-            dest = os.path.join(path, os.path.basename(file.path))
-
-            # Check if the name is already in use, rename new file if needed
-            dupe_rename = 1
-            while os.path.exists(dest):
-                fname = os.path.basename(file.path).split(".")
-                fname[-2] += "_{}".format(dupe_rename)
-                dest = os.path.join(path, '.'.join(fname))
-                dupe_rename += 1
-            os.rename(file.path, dest)
-            moves.append((file.path, dest))
-            file.path = dest.lstrip(self.path)
-
-        s = self.session()
-        s.add(photoset)
         try:
+            for file in photoset.files:
+                if self.content_addressed:
+                    file.name = os.path.basename(file.path)
+                    dest = os.path.join(self.path, self.object_path(file.hash, file.name))
+                    if os.path.exists(dest):
+                        raise FileExistsError("{} is already in the library as {}".format(file.path, dest))
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                else:
+                    dest = self.get_free_path(path, os.path.basename(file.path))
+                os.rename(file.path, dest)
+                moves.append((file.path, dest))
+                file.path = os.path.relpath(dest, self.path)
+            links = [(file.path, file.hash, file.name, photoset.date) for file in photoset.files]
+
+            s = self.session()
+            s.add(photoset)
             s.commit()
-        except IntegrityError:
+        except (IntegrityError, FileExistsError):
             # Commit failed, undo the moves
             for move in moves:
                 os.rename(move[1], move[0])
             raise
 
+        if self.content_addressed:
+            for link in links:
+                self.link_view(*link)
+
+    @staticmethod
+    def get_free_path(dirpath, basename):
+        """
+        Return a path in dirpath for a file called basename, renaming it to name_1.ext, name_2.ext etc if the name is
+        already in use
+        """
+        dest = os.path.join(dirpath, basename)
+        dupe_rename = 1
+        while os.path.exists(dest):
+            fname = basename.split(".")
+            fname[-2] += "_{}".format(dupe_rename)
+            dest = os.path.join(dirpath, '.'.join(fname))
+            dupe_rename += 1
+        return dest
+
+    def set_offset(self, session, ids, offset):
+        """
+        Set the date offset of many PhotoSets at once: a single UPDATE sets date = date_real + offset for every set
+        whose id is selected, then any files now sitting in the wrong date directory are moved.
+        :param ids: query or subquery selecting PhotoSet.id
+        :param offset: offset in minutes
+        :return: tuple of (number of files moved, list of paths of files that couldn't be), see rehome_files()
+        """
+        # sqlite's datetime() drops the fractional seconds sqlalchemy stores, carry them over from date_real
+        shifted = func.datetime(PhotoSet.date_real, "{:+d} minutes".format(offset)). \
+            op("||")(func.substr(PhotoSet.date_real, 20))
+        if self.content_addressed:
+            for row in self.iter_stored(session, ids):
+                self.unlink_view(*row)
+        session.query(PhotoSet).filter(PhotoSet.id.in_(ids)). \
+            update({PhotoSet.date_offset: offset, PhotoSet.date: shifted}, synchronize_session=False)
+        session.commit()
+        return self.rehome_files(session, ids)
+
+    def rehome_files(self, session, ids, chunk=1000):
+        """
+        Move files of the selected PhotoSets whose date directory no longer matches the set's date. Stored files of a
+        content addressed library never move, only their links in the date tree are made. Files that can't be moved
+        or linked are skipped and left where they are.
+        :param ids: query or subquery selecting PhotoSet.id
+        :return: tuple of (number of files moved, list of paths of skipped files)
+        """
+        skipped = []
+        if self.content_addressed:
+            for row in self.iter_stored(session, ids, chunk):
+                try:
+                    self.link_view(*row)
+                except OSError:
+                    traceback.print_exc()
+                    skipped.append(row[0])
+            return 0, skipped
+        moved = 0
+        after = 0
+        while True:
+            rows = session.query(Photo.id, Photo.path, PhotoSet.date).join(PhotoSet). \
+                filter(PhotoSet.id.in_(ids), Photo.id > after).order_by(Photo.id).limit(chunk).all()
+            if not rows:
+                break
+            after = rows[-1][0]
+            for fid, path, date in rows:
+                datedir = self.get_datedir_path(date)
+                if os.path.dirname(path) == datedir:
+                    continue
+                try:
+                    os.makedirs(os.path.join(self.path, datedir), exist_ok=True)
+                    dest = self.get_free_path(os.path.join(self.path, datedir), os.path.basename(path))
+                    os.rename(os.path.join(self.path, path), dest)
+                except OSError:
+                    traceback.print_exc()
+                    skipped.append(path)
+                    continue
+                session.query(Photo).filter(Photo.id == fid). \
+                    update({Photo.path: os.path.relpath(dest, self.path)}, synchronize_session=False)
+                session.commit()
+                moved += 1
+        return moved, skipped
+
     def get_datedir_path(self, date):
         """
         Return a path like 2018/3/31 given a datetime object representing the same date
         """
         return os.path.join(str(date.year), str(date.month), str(date.day))
 
+    @staticmethod
+    def object_path(fhash, name):
+        """
+        Return the path a file is stored at in a content addressed library, like objects/ab/cd/abcd..ef.jpg
+        """
+        return os.path.join(STORE_DIR, fhash[0:2], fhash[2:4], fhash + os.path.splitext(name)[1].lower())
+
+    def iter_stored(self, session, ids=None, chunk=1000):
+        """
+        Yield (path, hash, name, date) for the files of the selected PhotoSets, or all files
+        :param ids: query or subquery selecting PhotoSet.id
+        """
+        after = 0
+        while True:
+            query = session.query(Photo.id, Photo.path, Photo.hash, Photo.name, PhotoSet.date).join(PhotoSet). \
+                filter(Photo.id > after)
+            if ids is not None:
+                query = query.filter(PhotoSet.id.in_(ids))
+            rows = query.order_by(Photo.id).limit(chunk).all()
+            if not rows:
+                break
+            after = rows[-1][0]
+            for row in rows:
+                yield row[1:]
+
+    def view_paths(self, fhash, name, date):
+        """
+        Return where a stored file's link in the date tree can go: under its own name, or with the start of its hash
+        added when another file of the same name was taken that day
+        """
+        datedir = self.get_datedir_path(date)
+        stem, ext = os.path.splitext(name)
+        return [os.path.join(datedir, name), os.path.join(datedir, "{}_{}{}".format(stem, fhash[:8], ext))]
+
+    def link_view(self, path, fhash, name, date):
+        """
+        Link a stored file into the date tree. Hardlinks are used where the filesystem allows, so the tree can be read
+        and backed up like plain files, otherwise relative symlinks.
+        :return: path of the link, or None if both of its names are taken by other files
+        """
+        target = os.path.join(self.path, path)
+        for candidate in self.view_paths(fhash, name, date):
+            link = os.path.join(self.path, candidate)
+            if os.path.lexists(link):
+                if os.path.exists(link) and os.path.samefile(link, target):
+                    return candidate
+                continue
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            try:
+                os.link(target, link)
+            except FileExistsError:
+                continue
+            except OSError:
+                os.symlink(os.path.relpath(target, os.path.dirname(link)), link)
+            return candidate
+        return None
+
+    def unlink_view(self, path, fhash, name, date):
+        """
+        Remove a stored file's link from the date tree
+        """
+        target = os.path.join(self.path, path)
+        for candidate in self.view_paths(fhash, name, date):
+            link = os.path.join(self.path, candidate)
+            if os.path.exists(link) and os.path.samefile(link, target):
+                os.unlink(link)
+
+    def thumb_path(self, photo, style):
+        return os.path.join(self.cache_path, "thumbs", style, "{}.jpg".format(photo.uuid))
+
+    def cached_thumb(self, photo, style):
+        """
+        Return the local path to the photo's thumbnail in the given style if it has already been generated, else None
+        """
+        dest = self.thumb_path(photo, style)
+        if os.path.exists(dest):
+            THUMB_REQUESTS.inc(style=style, result="hit")
+            return os.path.abspath(dest)
+        return None
+
+    def can_thumb(self, photo, style):
+        """
+        Return False if there's no point trying to generate the thumbnail: nothing can open the format, or a previous
+        attempt failed
+        """
+        return get_backend(photo.format) is not None and photo.uuid not in self._failed_thumbs_cache[style]
+
     def make_thumb(self, photo, style):
         """
         Create a thumbnail of the given photo, scaled/cropped to the given named style
         :return: local path to thumbnail file or None if creation failed or was blocked
         """
-        # style tuples: max x, max y, rotate ok)
-        # rotate ok means x and y maxes can be swapped if it fits the image's aspect ratio better
-        styles = {"tiny": (80, 80, False),
-                  "small": (100, 100, False),
-                  "feed": (250, 250, False),
-                  "preview": (1024, 768, True),
-                  "big": (2048, 1536, True)}
-        dest = os.path.join(self.cache_path, "thumbs", style, "{}.jpg".format(photo.uuid))
-        if os.path.exists(dest):
-            return os.path.abspath(dest)
-        if photo.width is None:  # todo better detection of images that PIL can't open
+        cached = self.cached_thumb(photo, style)
+        if cached:
+            return cached
+        dest = self.thumb_path(photo, style)
+        if get_backend(photo.format) is None:  # nothing can open it, don't bother trying
+            THUMB_REQUESTS.inc(style=style, result="unsupported")
             return None
         if photo.uuid not in self._failed_thumbs_cache[style]:
-            thumb_width, thumb_height, flip_ok = styles[style]
-            i_width = photo.width
-            i_height = photo.height
-            im_is_rotated = photo.orientation % 2 != 0 or i_height > i_width
-
-            if im_is_rotated and flip_ok:
-                thumb_width, thumb_height = thumb_height, thumb_width
-
-            thumb_width = min(thumb_width, i_width if i_width > 0 else 999999999)  # TODO do we even have photo.width if PIL can't read the image?
-            thumb_height = min(thumb_height, i_height if i_height > 0 else 999999999)  # TODO this seems bad
-
-            p = Process(target=self.gen_thumb, args=(os.path.join(self.path, photo.path), dest, thumb_width, thumb_height, photo.orientation))
+            start = time()
+            p = Process(target=self.gen_thumb, args=(os.path.join(self.path, photo.path), photo.format, dest,
+                                                     THUMB_STYLES[style], photo.orientation))
             p.start()
             p.join()
+            THUMB_SECONDS.observe(time() - start, style=style)
             if p.exitcode != 0:
                 self._failed_thumbs_cache[style][photo.uuid] = True  # dont retry failed generations
+                THUMB_REQUESTS.inc(style=style, result="failed")
                 return None
+            THUMB_REQUESTS.inc(style=style, result="generated")
             return os.path.abspath(dest)
+        THUMB_REQUESTS.inc(style=style, result="skipped")
         return None
 
     @staticmethod
-    def gen_thumb(src_img, dest_img, width, height, rotation):
+    def gen_thumb(src_img, src_format, dest_img, style, rotation):
+        # written aside and renamed into place, so other processes never serve a partial file
+        tmp_img = "{}.{}.tmp".format(dest_img, os.getpid())
         try:
-            start = time()
             # TODO lock around the dir creation
             os.makedirs(os.path.split(dest_img)[0], exist_ok=True)
-            image = Image.open(src_img)
+            image = get_backend(src_format)(src_img)
             image = image.rotate(90 * rotation, expand=True)
-            thumb = ImageOps.fit(image, (width, height), Image.ANTIALIAS)
-            thumb.save(dest_img, 'JPEG')
-            print("Generated {} in {}s".format(dest_img, round(time() - start, 4)))
+
+            thumb_width, thumb_height, flip_ok = style
+            if flip_ok and image.height > image.width:
+                thumb_width, thumb_height = thumb_height, thumb_width
+            thumb_width = min(thumb_width, image.width)
+            thumb_height = min(thumb_height, image.height)
+
+            thumb = ImageOps.fit(image, (thumb_width, thumb_height), Image.ANTIALIAS)
+            thumb.save(tmp_img, 'JPEG')
+            os.replace(tmp_img, dest_img)
         except:
             traceback.print_exc()
-            if os.path.exists(dest_img):
-                os.unlink(dest_img)
+            if os.path.exists(tmp_img):
+                os.unlink(tmp_img)
             sys.exit(1)
@@ -0,0 +1,164 @@
+import cherrypy
+from time import time
+from bisect import bisect_left
+from threading import Lock
+from sqlalchemy import event
+
+
+"""
+In-process metrics exposed in the Prometheus text format. Metrics are module level and shared by everything in the
+process; each keeps one series per distinct set of label values.
+"""
+
+REGISTRY = []
+
+# seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(k, escape(v)) for k, v in pairs) + "}"
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}
+        self.lock = Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            series = sorted(self.series.items())
+        for key, value in series:
+            lines.extend(self.render_series(key, value))
+        return lines
+
+    def render_series(self, key, value):
+        return ["{}{} {}".format(self.name, format_labels(self.labels, key), value)]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.series:
+                # per-bucket counts (the last being +Inf), sum
+                self.series[key] = [[0] * (len(self.buckets) + 1), 0]
+            series = self.series[key]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render_series(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name, format_labels(self.labels, key, [("le", bound)]),
+                                                 cumulative))
+        lines.append("{}_sum{} {}".format(self.name, format_labels(self.labels, key), total))
+        lines.append("{}_count{} {}".format(self.name, format_labels(self.labels, key), cumulative))
+        return lines
+
+
+def render():
+    """
+    Return all metrics in the Prometheus text exposition format
+    """
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+REQUEST_SECONDS = Histogram("photoapp_request_seconds", "Time spent handling http requests",
+                            ("route", "method", "status"))
+SQL_SECONDS = Histogram("photoapp_sql_seconds", "Time spent executing sql statements", ("statement", ))
+THUMB_REQUESTS = Counter("photoapp_thumb_requests_total", "Thumbnail lookups by cache outcome", ("style", "result"))
+THUMB_SECONDS = Histogram("photoapp_thumb_generate_seconds", "Time spent generating thumbnails", ("style", ))
+STREAMS = Gauge("photoapp_streams", "Original file and archive download counters", ("stat", ))
+
+
+class MetricsTool(cherrypy.Tool):
+    """
+    Record the latency of every request in REQUEST_SECONDS. Routes are named after their handler, e.g.
+    "ThumbnailView.index", so urls that differ only by uuid share a series.
+    """
+    def __init__(self):
+        super().__init__("on_start_resource", self.start)
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.request.hooks.attach("on_end_request", self.finish)
+
+    @staticmethod
+    def start():
+        # later tools wrap the handler, so it's named while it is still the one dispatch found
+        handler = getattr(cherrypy.request.handler, "callable", None)
+        cherrypy.request.route = getattr(handler, "__qualname__", None) or "unmatched"
+
+    @staticmethod
+    def finish():
+        # runs once the response has been sent, so streamed bodies are included
+        REQUEST_SECONDS.observe(time() - cherrypy.response.time, route=getattr(cherrypy.request, "route", "unmatched"),
+                                method=cherrypy.request.method, status=str(cherrypy.response.status).split(" ")[0])
+
+
+cherrypy.tools.metrics = MetricsTool()
+
+
+# functions called with (statement, seconds) for every statement timed by instrument_engine()
+STATEMENT_HOOKS = []
+
+
+def instrument_engine(engine):
+    """
+    Time every statement run on the engine. The start time is kept on the statement's execution context, connections
+    can be shared between threads.
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time() - context._query_start
+        SQL_SECONDS.observe(seconds, statement=(statement.split(None, 1) or ["none"])[0].upper())
+        for hook in STATEMENT_HOOKS:
+            hook(statement, seconds)
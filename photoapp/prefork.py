@@ -0,0 +1,108 @@
+import os
+import socket
+import signal
+import logging
+import traceback
+from time import time, sleep
+from cherrypy.lib import sessions
+
+
+"""
+Pre-fork serving. The supervisor binds the listening socket once and forks worker processes, each a complete cherrypy
+server accepting connections from it. The socket is handed over the way systemd socket activation does it - as fd 3
+with LISTEN_PID set - which cheroot and cherrypy already know to use instead of binding their own. Sessions are kept
+on disk so any worker can serve any request.
+"""
+
+LISTEN_FD = 3
+
+
+def listen(host, port, backlog=1024):
+    """
+    Bind the socket workers will accept on and set it up to be picked up by their servers. If we were started by
+    systemd socket activation it is already in place.
+    """
+    if os.environ.get("LISTEN_PID"):
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    if sock.fileno() == LISTEN_FD:
+        sock.detach()
+    else:
+        os.dup2(sock.fileno(), LISTEN_FD)
+        sock.close()
+    os.environ["LISTEN_PID"] = str(os.getpid())
+
+
+def supervise(workers, serve):
+    """
+    Run `serve` in `workers` forked processes, replacing any that exit, until the supervisor is sent SIGINT or SIGTERM
+    """
+    children = {}  # pid -> start time
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 1
+            try:
+                serve()
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        children[pid] = time()
+
+    def stop(signum, stack):
+        nonlocal stopping
+        logging.critical('Got sig {}, stopping workers...'.format(signum))
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for i in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logging.error("worker {} exited with status {}, restarting".format(pid, status))
+        if time() - started < 1:
+            sleep(1)  # don't spin if workers die as soon as they start
+        spawn()
+
+
+class FileSession(sessions.FileSession):
+    """
+    File sessions for the app's explicit session locking: loads, saves and deletes hold the session's file lock only
+    for the file access, rather than requests having to lock the session themselves
+    """
+    def locked_call(self, method, *args):
+        if self.locked:
+            return method(*args)
+        self.acquire_lock()
+        try:
+            return method(*args)
+        finally:
+            self.release_lock()
+
+    def _load(self, path=None):
+        return self.locked_call(super()._load, path)
+
+    def _save(self, expiration_time):
+        return self.locked_call(super()._save, expiration_time)
+
+    def _delete(self):
+        return self.locked_call(super()._delete)
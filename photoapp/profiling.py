@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import cherrypy
+import threading
+from time import time, sleep
+from datetime import datetime
+from collections import Counter, deque
+
+
+"""
+Opt-in slow request capture. While enabled, a background thread samples the stack of every thread that is handling a
+request. Requests that take longer than the threshold have their samples written out in the "folded" format read by
+flamegraph.pl and speedscope, alongside a json summary of the route, the sql statements run and where the time went.
+"""
+
+# sample stacks containing these modules are attributed to the category, first match wins
+CATEGORIES = [("sql", ("sqlalchemy", "sqlite3")),
+              ("thumbnail", ("multiprocessing", "PIL")),
+              ("template", ("jinja2", )),
+              ("file", ("cherrypy/lib/static", "zipfile", "photoapp/streaming"))]
+
+
+def frame_name(code):
+    return "{}:{}".format(os.path.relpath(code.co_filename) if "site-packages" not in code.co_filename
+                          else code.co_filename.split("site-packages" + os.sep)[-1], code.co_name)
+
+
+def fold(frame, limit=128):
+    """
+    Return a stack as "outermost;...;innermost" frame names
+    """
+    names = []
+    while frame is not None and len(names) < limit:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def categorize(stack):
+    for category, modules in CATEGORIES:
+        if any(module in stack for module in modules):
+            return category
+    return "other"
+
+
+class SlowRequestProfiler(object):
+    """
+    :param threshold: seconds a request may take before it is recorded
+    :param dump_dir: directory profiles are written to
+    :param interval: seconds between stack samples
+    :param keep: number of slow requests remembered for slowest(), and of profiles kept in dump_dir
+    """
+    def __init__(self, threshold, dump_dir, interval=0.005, keep=200):
+        self.threshold = threshold
+        self.dump_dir = dump_dir
+        self.interval = interval
+        self.keep = keep
+        self.recent = deque(maxlen=keep)
+        self.active = {}  # thread id -> Counter of folded stacks
+        self.lock = threading.Lock()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while True:
+            sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self.active.items():
+                    if thread_id in frames:
+                        samples[fold(frames[thread_id])] += 1
+
+    def start(self):
+        cherrypy.request.profile = {"samples": Counter(), "sql": []}
+        with self.lock:
+            self.active[threading.get_ident()] = cherrypy.request.profile["samples"]
+
+    def finish(self):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+        elapsed = time() - cherrypy.response.time
+        if elapsed < self.threshold:
+            return
+        try:
+            self.save(elapsed)
+            self.prune()
+        except Exception:
+            cherrypy.log.error("could not save request profile", traceback=True)
+
+    def save(self, elapsed):
+        request = cherrypy.request
+        samples = request.profile["samples"]
+        sql = request.profile["sql"]
+        total = sum(samples.values())
+        breakdown = Counter()
+        for stack, count in samples.items():
+            breakdown[categorize(stack)] += count
+        name = "{}-{}".format(datetime.now().strftime("%Y%m%d-%H%M%S-%f"), getattr(request, "route", "unmatched"))
+        entry = {"time": datetime.now().isoformat(),
+                 "route": getattr(request, "route", "unmatched"),
+                 "method": request.method,
+                 "url": request.path_info + ("?" + request.query_string if request.query_string else ""),
+                 "status": str(cherrypy.response.status),
+                 "seconds": elapsed,
+                 "sql_seconds": sum(seconds for statement, seconds in sql),
+                 "sql_count": len(sql),
+                 "breakdown": {category: count / total for category, count in breakdown.most_common()} if total else {},
+                 "profile": os.path.join(self.dump_dir, name + ".folded")}
+        os.makedirs(self.dump_dir, exist_ok=True)
+        with open(entry["profile"], "w") as f:
+            for stack, count in samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+        with open(os.path.join(self.dump_dir, name + ".json"), "w") as f:
+            json.dump(dict(entry, sql=[{"statement": statement, "seconds": seconds} for statement, seconds in sql]),
+                      f, indent=4)
+        self.recent.append(entry)
+
+    def prune(self):
+        """
+        Delete the oldest profiles in dump_dir beyond the newest `keep`. Names start with the time they were saved.
+        """
+        names = sorted(name[:-len(".json")] for name in os.listdir(self.dump_dir) if name.endswith(".json"))
+        for name in names[:-self.keep]:
+            for ext in (".json", ".folded"):
+                try:
+                    os.unlink(os.path.join(self.dump_dir, name + ext))
+                except FileNotFoundError:  # another worker got to it first
+                    pass
+
+    def slowest(self, n=20):
+        """
+        Return the n slowest of the recently recorded requests
+        """
+        return sorted(self.recent, key=lambda entry: entry["seconds"], reverse=True)[:n]
+
+    def record_statement(self, statement, seconds):
+        """
+        Record a statement against the request being profiled, if any. Subscribed to photoapp.metrics.STATEMENT_HOOKS
+        so statements are timed once.
+        """
+        profile = getattr(cherrypy.request, "profile", None)
+        if profile is not None:
+            profile["sql"].append((statement, seconds))
+
+    def tool(self):
+        """
+        Return a cherrypy tool profiling the requests it's enabled for
+        """
+        return ProfileTool(self)
+
+
+class ProfileTool(cherrypy.Tool):
+    def __init__(self, profiler):
+        self.profiler = profiler
+        super().__init__("on_start_resource", profiler.start, priority=60)
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.request.hooks.attach("on_end_request", self.profiler.finish)
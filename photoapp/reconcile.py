@@ -0,0 +1,100 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from photoapp.library import PhotoLibrary, STORE_DIR
+from photoapp.validate import iter_files
+
+
+"""
+Drift detection between the library directory and the files table. Both sides are produced in sorted path order - the
+tree by a parallel directory walk, the table by a keyset-paginated query - and joined in a single streaming merge, so
+memory use doesn't grow with the size of the library.
+"""
+
+
+def scan_dir(path):
+    """
+    List a directory as sorted (name, size) tuples. Subdirectories get a trailing slash and a size of None; sorting
+    on that name places their contents exactly where they fall in a sort of full paths.
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                entries.append((entry.name + "/", None))
+            elif entry.is_file(follow_symlinks=False):
+                entries.append((entry.name, entry.stat(follow_symlinks=False).st_size))
+    entries.sort()
+    return entries
+
+
+def walk_library(root, workers=16):
+    """
+    Yield (relpath, size) for every file under root in sorted order. When a directory is entered, all of its
+    subdirectories are listed in parallel - e.g. every day of a month at once - while its entries are being consumed.
+    """
+    with ThreadPoolExecutor(workers) as pool:
+        yield from _walk(pool, root, "", pool.submit(scan_dir, root))
+
+
+def _walk(pool, root, prefix, listing):
+    entries = listing.result()
+    subdirs = {name: pool.submit(scan_dir, os.path.join(root, prefix, name)) for name, size in entries if size is None}
+    for name, size in entries:
+        if size is None:
+            yield from _walk(pool, root, prefix + name, subdirs.pop(name))
+        else:
+            yield prefix + name, size
+
+
+def reconcile(library, chunk=1000):
+    """
+    Compare the library tree against the files table, yielding (problem, path, detail) tuples:
+     * "orphan": file on disk with no row
+     * "missing": row whose file doesn't exist
+     * "size": file and row disagree on size, detail holds both
+     * "duplicate": more than one row points at the same path
+    Content addressed libraries are checked against the store, the date tree being only links.
+    :param chunk: rows fetched from the database at a time
+    """
+    if library.content_addressed:
+        disk = ((STORE_DIR + "/" + path, size) for path, size in walk_library(os.path.join(library.path, STORE_DIR)))
+    else:
+        disk = walk_library(library.path)
+    rows = ((path, size) for fid, path, fhash, size in iter_files(library, chunk=chunk))
+    ondisk = next(disk, None)
+    row = next(rows, None)
+    last = None
+    while ondisk or row:
+        if row and row[0] == last:
+            yield "duplicate", row[0], None
+            row = next(rows, None)
+        elif row is None or (ondisk and ondisk[0] < row[0]):
+            yield "orphan", ondisk[0], None
+            ondisk = next(disk, None)
+        elif ondisk is None or row[0] < ondisk[0]:
+            yield "missing", row[0], None
+            last = row[0]
+            row = next(rows, None)
+        else:
+            if row[1] != ondisk[1]:
+                yield "size", row[0], "db {} disk {}".format(row[1], ondisk[1])
+            last = row[0]
+            ondisk = next(disk, None)
+            row = next(rows, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Library/database drift detection tool")
+    parser.parse_args()
+    library = PhotoLibrary("photos.db", "./library/", "./cache/")
+    problems = 0
+    for problem, path, detail in reconcile(library):
+        print("\t".join([problem, path] + ([detail] if detail else [])))
+        problems += 1
+    print("{} problems".format(problems))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    exit(main())
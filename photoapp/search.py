@@ -0,0 +1,69 @@
+from sqlalchemy import text
+from sqlalchemy.sql import table, column
+from photoapp.types import PhotoSet
+
+
+"""
+Full text search over photo set titles and descriptions and the titles, names and descriptions of their tags. The
+photos_fts table is an sqlite FTS5 index with one row per PhotoSet (rowid = photos.id), kept in sync by triggers so
+every write path - the web ui, cli tools, ingest - updates it without having to know it exists.
+"""
+
+fts = table("photos_fts", column("rowid"), column("rank"))
+
+# text indexed for the set with id {0}
+TAG_TEXT = "(SELECT group_concat(coalesce(tags.title, '') || ' ' || coalesce(tags.name, '') || ' ' || " \
+           "coalesce(tags.description, ''), ' ') FROM tag_items JOIN tags ON tags.id = tag_items.tag_id " \
+           "WHERE tag_items.set_id = {0})"
+
+# index sets matching the condition {0}
+POPULATE = "INSERT INTO photos_fts (rowid, title, description, tags) " \
+           "SELECT id, title, description, " + TAG_TEXT.format("photos.id") + " FROM photos WHERE {0};"
+
+# replace the index rows of sets matching the condition {0}
+REFRESH = "DELETE FROM photos_fts WHERE rowid IN (SELECT id FROM photos WHERE {0}); " + POPULATE
+
+TRIGGERS = {
+    "photos_fts_insert": "AFTER INSERT ON photos BEGIN " + REFRESH.format("id = NEW.id") + " END",
+    "photos_fts_update": "AFTER UPDATE OF title, description ON photos BEGIN " +
+                         REFRESH.format("id = NEW.id") + " END",
+    "photos_fts_delete": "AFTER DELETE ON photos BEGIN DELETE FROM photos_fts WHERE rowid = OLD.id; END",
+    "photos_fts_tag": "AFTER INSERT ON tag_items BEGIN " + REFRESH.format("id = NEW.set_id") + " END",
+    "photos_fts_untag": "AFTER DELETE ON tag_items BEGIN " + REFRESH.format("id = OLD.set_id") + " END",
+    "photos_fts_tag_edit": "AFTER UPDATE OF title, name, description ON tags BEGIN " +
+                           REFRESH.format("id IN (SELECT set_id FROM tag_items WHERE tag_id = NEW.id)") + " END",
+}
+
+
+def create_index(engine):
+    """
+    Create the search index and its triggers if they don't exist yet, indexing any existing photos
+    """
+    with engine.begin() as c:
+        exists = c.execute("SELECT count(*) FROM sqlite_master WHERE name = 'photos_fts'").scalar()
+        if not exists:
+            c.execute("CREATE VIRTUAL TABLE photos_fts USING fts5(title, description, tags, "
+                      "tokenize = 'unicode61 remove_diacritics 1', prefix = '2 3')")
+            c.execute(POPULATE.format("1"))
+        for name, body in TRIGGERS.items():
+            c.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body))
+
+
+def make_match(words):
+    """
+    Turn free text from the user into an FTS5 query: every word must match, the last as a prefix so results show up
+    while the user is still typing. Words are quoted so FTS5 syntax characters are taken literally.
+    """
+    terms = ['"{}"'.format(word.replace('"', '""')) for word in words.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_filter(query, words):
+    """
+    Sqlalchemy helper: filter and order the given PhotoSet query to sets matching the search words, best first
+    """
+    return query.join(fts, fts.c.rowid == PhotoSet.id). \
+        filter(text("photos_fts MATCH :match").bindparams(match=make_match(words))). \
+        order_by(fts.c.rank)
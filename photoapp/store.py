@@ -0,0 +1,88 @@
+import os
+import argparse
+from photoapp.library import PhotoLibrary, STORE_DIR
+from photoapp.types import Photo
+
+
+"""
+Content addressed storage. Originals are kept at objects/ab/cd/<sha256>.<ext>, so placing a file never depends on what
+else is in the library and an identical file is found by a single stat. The familiar YYYY/M/D/<name> tree is kept as
+links to the stored files, which can be regenerated from the database at any time. Changing a set's date offset then
+only moves links, never the files themselves.
+"""
+
+
+def convert(library, chunk=1000):
+    """
+    Move the files of a date tree library into the store, leaving links in the date tree where they were. Safe to run
+    again after an interruption.
+    :return: number of files moved
+    """
+    os.makedirs(os.path.join(library.path, STORE_DIR), exist_ok=True)
+    library.content_addressed = True
+    s = library.session()
+    moved = 0
+    after = 0
+    while True:
+        query = s.query(Photo.id, Photo.path, Photo.hash).filter(Photo.id > after, Photo.name == None)  # NOQA
+        rows = query.order_by(Photo.id).limit(chunk).all()
+        if not rows:
+            break
+        after = rows[-1][0]
+        for fid, path, fhash in rows:
+            name = os.path.basename(path)
+            dest = library.object_path(fhash, name)
+            src = os.path.join(library.path, path)
+            if os.path.exists(src):
+                os.makedirs(os.path.join(library.path, os.path.dirname(dest)), exist_ok=True)
+                os.rename(src, os.path.join(library.path, dest))
+                moved += 1
+            elif not os.path.exists(os.path.join(library.path, dest)):
+                print("Skipping missing file: {}".format(path))
+                continue
+            s.query(Photo).filter(Photo.id == fid).update({Photo.path: dest, Photo.name: name},
+                                                          synchronize_session=False)
+        s.commit()
+        print("  moved: {}\r".format(moved), end='')
+    print()
+    s.close()
+    return moved, rebuild_view(library)
+
+
+def rebuild_view(library):
+    """
+    Create any links missing from the date tree, e.g. after restoring only the store from a backup
+    :return: number of files with a link in the date tree
+    """
+    s = library.session()
+    linked = 0
+    for row in library.iter_stored(s):
+        if library.link_view(*row) is None:
+            print("No free name in the date tree for {}".format(row[0]))
+        else:
+            linked += 1
+    s.close()
+    return linked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Content addressed storage tool")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--convert", action="store_true",
+                        help="move the library's files into the content addressed store, linking them into the date "
+                             "tree")
+    action.add_argument("--rebuild-view", action="store_true", help="recreate missing links in the date tree")
+    args = parser.parse_args()
+
+    library = PhotoLibrary("photos.db", "./library/", "./cache/")
+    if args.convert:
+        moved, linked = convert(library)
+        print("{} files moved, {} linked".format(moved, linked))
+    else:
+        if not library.content_addressed:
+            parser.error("the library is not content addressed, see --convert")
+        print("{} files linked".format(rebuild_view(library)))
+
+
+if __name__ == '__main__':
+    main()
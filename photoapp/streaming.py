@@ -0,0 +1,196 @@
+import os
+import zipfile
+import threading
+import cherrypy
+from time import time
+
+
+class RetryLater(cherrypy.HTTPError):
+    """
+    503 with a Retry-After header. HTTPError.set_response() clears Retry-After along with other headers, so it is added
+    back afterwards.
+    """
+    def __init__(self, seconds, message=None):
+        super().__init__(503, message)
+        self.seconds = seconds
+
+    def set_response(self):
+        super().set_response()
+        cherrypy.serving.response.headers['Retry-After'] = str(self.seconds)
+
+
+class StreamLimiter(object):
+    """
+    Bound the number of large downloads being streamed at once, so a handful of video viewers can't tie up every
+    request thread, and keep running counters of what has been sent.
+    """
+    def __init__(self, max_streams=8, min_size=16 * 1024 * 1024):
+        """
+        :param max_streams: number of concurrent large streams allowed before new ones are refused with a 503
+        :param min_size: responses at least this many bytes long count as large
+        """
+        self.max_streams = max_streams
+        self.min_size = min_size
+        self.slots = threading.BoundedSemaphore(max_streams)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.streams = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self.started = time()
+
+    def reserve(self, size):
+        """
+        If a response of `size` bytes is large, take a stream slot held until the request finishes - or raise a 503 if
+        none are free. Call before opening anything, so a refused request has nothing to clean up.
+        """
+        if size < self.min_size:
+            return
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise RetryLater(5, "Too many concurrent downloads")
+        with self.lock:
+            self.active += 1
+            self.streams += 1
+        # on_end_request runs once the body has been sent or the client has gone away
+        cherrypy.serving.request.hooks.attach('on_end_request', self._release)
+
+    def count(self):
+        """
+        Wrap the current response body so its bytes are counted
+        """
+        response = cherrypy.serving.response
+        response.stream = True
+        response.body = self._counted(response.body)
+
+    def handed_off(self, size):
+        """
+        Count a transfer of `size` bytes made by the fronting web server. It holds no request thread, so takes no slot.
+        """
+        with self.lock:
+            self.streams += 1
+            self.bytes_sent += size
+
+    def _release(self):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+    def _counted(self, body):
+        for chunk in body:
+            with self.lock:
+                self.bytes_sent += len(chunk)
+            yield chunk
+
+    def stats(self):
+        """
+        Return a dict of counters describing stream activity since startup
+        """
+        with self.lock:
+            elapsed = time() - self.started
+            return {"active": self.active,
+                    "max": self.max_streams,
+                    "streams": self.streams,
+                    "rejected": self.rejected,
+                    "bytes_sent": self.bytes_sent,
+                    "throughput": self.bytes_sent / elapsed if elapsed else 0}
+
+
+def serve_original(limiter, library_path, relpath, content_type, download_name=None, accel_prefix=None):
+    """
+    Serve a file from the library, honoring byte-range requests (single and multipart). When accel_prefix is set the
+    transfer is handed off to the fronting web server (nginx X-Accel-Redirect) which can use sendfile() and keeps our
+    request threads free entirely.
+    :param download_name: if set, the client is asked to save the file under this name
+    """
+    fpath = os.path.abspath(os.path.join(library_path, relpath))
+    try:
+        size = os.path.getsize(fpath)
+    except OSError:  # the database lists a file that isn't there
+        raise cherrypy.HTTPError(404)
+    if accel_prefix:
+        limiter.handed_off(size)
+        response = cherrypy.serving.response
+        response.headers['Content-Type'] = content_type
+        response.headers['X-Accel-Redirect'] = "/".join([accel_prefix.rstrip("/"), relpath.lstrip("/")])
+        if download_name:
+            response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(download_name)
+        return b''
+    limiter.reserve(size)
+    extra = {}
+    if download_name:
+        extra.update(disposition="attachment", name=download_name)
+    # serve_file deals with Range/If-Range/If-Modified-Since and sets the 206/416 status as needed
+    cherrypy.lib.static.serve_file(fpath, content_type=content_type, **extra)
+    limiter.count()
+    return cherrypy.serving.response.body
+
+
+class _ZipSink(object):
+    """
+    Write-only, unseekable file object for ZipFile. Data written to it is held only until the next drain()
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(library_path, entries, chunk_size=1024 * 1024):
+    """
+    Generate a zip archive of library files on the fly. Members are STORED - photos and videos don't compress - and
+    written with data descriptors, so CRCs are computed as the bytes go by and nothing is buffered beyond one chunk.
+    Files that can't be opened by the time they're reached are left out, keeping the archive valid.
+    :param entries: iterable of (relpath in library, name in archive, size, datetime) tuples
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for relpath, name, size, date in entries:
+            # zip timestamps can't predate 1980
+            info = zipfile.ZipInfo(name, date_time=max(date.timetuple()[0:6], (1980, 1, 1, 0, 0, 0)))
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = size  # lets zipfile decide up front whether the member needs zip64 headers
+            try:
+                src = open(os.path.join(library_path, relpath), "rb")
+            except OSError:
+                cherrypy.log.error("left {} out of the archive".format(relpath), traceback=True)
+                continue
+            with src, zf.open(info, "w") as dest:
+                while True:
+                    piece = src.read(chunk_size)
+                    if not piece:
+                        break
+                    dest.write(piece)
+                    yield sink.drain()
+            yield sink.drain()  # data descriptor
+    yield sink.drain()  # central directory
+
+
+def serve_zip(limiter, library_path, entries, name):
+    """
+    Stream a zip of the given library files to the client as an attachment
+    :param entries: list of (relpath, name in archive, size, datetime) tuples, see zip_stream()
+    """
+    limiter.reserve(sum(entry[2] for entry in entries))
+    response = cherrypy.serving.response
+    response.headers['Content-Type'] = "application/zip"
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(name)
+    response.body = zip_stream(library_path, entries)
+    limiter.count()
+    return response.body
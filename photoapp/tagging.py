@@ -0,0 +1,51 @@
+from sqlalchemy import select, literal, exists, and_
+from photoapp.types import PhotoSet, TagItem, Tag
+
+
+"""
+Bulk tag operations. Each one is a single statement no matter how many photos are affected. The *_rowwise versions are
+the original one-row-at-a-time implementations, kept for benchmarking against.
+"""
+
+
+def add_tag(session, tag_id, ids):
+    """
+    Tag every selected PhotoSet that doesn't already have the tag
+    :param ids: query or subquery selecting PhotoSet.id
+    """
+    missing = select([literal(tag_id), PhotoSet.id]). \
+        where(PhotoSet.id.in_(ids)). \
+        where(~exists().where(and_(TagItem.tag_id == tag_id, TagItem.set_id == PhotoSet.id)))
+    session.execute(TagItem.__table__.insert().from_select(["tag_id", "set_id"], missing))
+
+
+def remove_tag(session, tag_id, ids):
+    """
+    Remove the tag from every selected PhotoSet
+    """
+    session.query(TagItem).filter(TagItem.tag_id == tag_id, TagItem.set_id.in_(ids)). \
+        delete(synchronize_session=False)
+
+
+def set_tag_status(session, tag_id, status):
+    """
+    Set the PhotoStatus of every PhotoSet under the tag
+    """
+    session.query(PhotoSet).filter(PhotoSet.id.in_(session.query(TagItem.set_id).filter(TagItem.tag_id == tag_id))). \
+        update({PhotoSet.status: status}, synchronize_session=False)
+
+
+def add_tag_rowwise(session, tag_id, ids):
+    for photo in session.query(PhotoSet).filter(PhotoSet.id.in_(ids)).all():
+        if 0 == session.query(TagItem).filter(TagItem.tag_id == tag_id, TagItem.set_id == photo.id).count():
+            session.add(TagItem(tag_id=tag_id, set_id=photo.id))
+
+
+def remove_tag_rowwise(session, tag_id, ids):
+    for photo in session.query(PhotoSet).filter(PhotoSet.id.in_(ids)):
+        session.query(TagItem).filter(TagItem.tag_id == tag_id, TagItem.set_id == photo.id).delete()
+
+
+def set_tag_status_rowwise(session, tag_id, status):
+    for photo in session.query(PhotoSet).join(TagItem).join(Tag).filter(Tag.id == tag_id).all():
+        photo.status = status
@@ -0,0 +1,143 @@
+import mmap
+import shutil
+import struct
+import subprocess
+from io import BytesIO
+from PIL import Image
+
+
+"""
+Thumbnail backends, keyed by mime type. A backend takes the path to an original and returns a PIL image that the
+regular thumbnail pipeline can rotate, crop, scale and cache. Formats without a backend get the placeholder image
+without any attempt being made.
+"""
+
+backends = {}
+
+
+def thumbnail_backend(*formats):
+    """
+    Decorator: register the decorated function as the image loader for the given mime types
+    """
+    def wrapped(func):
+        for fmt in formats:
+            backends[fmt] = func
+        return func
+    return wrapped
+
+
+def get_backend(fmt):
+    """
+    Return the image loader for the given mime type, or None if we can't make thumbnails of it
+    """
+    return backends.get(fmt)
+
+
+@thumbnail_backend("image/jpeg", "image/png", "image/gif")
+def load_image(path):
+    return Image.open(path)
+
+
+FFMPEG = shutil.which("ffmpeg")
+
+
+def load_video_frame(path, offset=1):
+    """
+    Extract a single poster frame from a video using ffmpeg. The frame is taken a second in, to skip the black or
+    blurry frames many cameras start with, falling back to the first frame for very short clips.
+    """
+    for seek in (offset, 0):
+        frame = subprocess.run([FFMPEG, "-v", "error", "-ss", str(seek), "-i", path, "-frames:v", "1",
+                                "-f", "image2pipe", "-vcodec", "mjpeg", "-"],
+                               stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, timeout=120, check=True).stdout
+        if frame:
+            return Image.open(BytesIO(frame))
+    raise Exception("No frames decoded from {}".format(path))
+
+
+if FFMPEG:
+    thumbnail_backend("video/mp4", "video/quicktime")(load_video_frame)
+
+
+# start of frame markers of baseline, extended and progressive jpegs - the kinds Pillow decodes. CR2 sensor data is
+# stored as a lossless jpeg (SOF3) and must not be mistaken for a preview.
+DECODABLE_SOF = (0xc0, 0xc1, 0xc2)
+
+
+def jpeg_frame(buf, offset, length):
+    """
+    Walk the marker segments of the jpeg at offset up to its start of frame
+    :return: tuple of (SOF marker, sample precision), or None if there's no frame header
+    """
+    pos, end = offset + 2, offset + length
+    while pos + 4 <= end and buf[pos] == 0xff:
+        marker = buf[pos + 1]
+        if marker == 0xff:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:  # no length field
+            pos += 2
+            continue
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            return (marker, buf[pos + 4]) if pos + 5 <= end else None
+        if marker == 0xda:  # scan data without a frame header
+            return None
+        pos += 2 + struct.unpack(">H", buf[pos + 2:pos + 4])[0]
+    return None
+
+
+def find_tiff_jpegs(buf):
+    """
+    Walk the IFD chain of a TIFF-structured file (such as a Canon CR2) and find the embedded JPEG previews: the strip
+    of the first IFD, and any JPEGInterchangeFormat thumbnails. Strips of later IFDs hold raw data - in a CR2, the
+    sensor data as a lossless jpeg - and only 8 bit jpegs Pillow can decode are returned.
+    :param buf: bytes-like object holding the file, ideally a mmap so only the headers are paged in
+    :return: tuple of ([(offset, length), ...], orientation tag value from the first IFD)
+    """
+    order = {b"II": "<", b"MM": ">"}.get(bytes(buf[0:2]))
+    if order is None or struct.unpack(order + "H", buf[2:4])[0] != 42:
+        raise Exception("Not a TIFF structured file")
+    found = []
+    orientation = 1
+    ifd = struct.unpack(order + "I", buf[4:8])[0]
+    seen = set()
+    while ifd and ifd not in seen and ifd + 2 <= len(buf):
+        seen.add(ifd)
+        count = struct.unpack(order + "H", buf[ifd:ifd + 2])[0]
+        tags = {}
+        for i in range(count):
+            entry = ifd + 2 + i * 12
+            tag, typ, num = struct.unpack(order + "HHI", buf[entry:entry + 8])
+            if num != 1:
+                continue  # multi-strip images are never the jpeg previews
+            fmt, size = ("H", 2) if typ == 3 else ("I", 4)  # SHORT or LONG
+            tags[tag] = struct.unpack(order + fmt, buf[entry + 8:entry + 8 + size])[0]
+        regions = [(0x0201, 0x0202)]  # JPEGInterchangeFormat
+        if len(seen) == 1:
+            orientation = tags.get(0x0112, orientation)
+            regions.append((0x0111, 0x0117))  # StripOffsets
+        for offset_tag, length_tag in regions:
+            offset, length = tags.get(offset_tag), tags.get(length_tag)
+            if offset and length and offset + length <= len(buf) and buf[offset:offset + 2] == b"\xff\xd8":
+                frame = jpeg_frame(buf, offset, length)
+                if frame and frame[0] in DECODABLE_SOF and frame[1] == 8:
+                    found.append((offset, length))
+        next_ptr = ifd + 2 + count * 12
+        ifd = struct.unpack(order + "I", buf[next_ptr:next_ptr + 4])[0] if next_ptr + 4 <= len(buf) else 0
+    return found, orientation
+
+
+@thumbnail_backend("image/x-canon-cr2")
+def load_raw_preview(path):
+    """
+    Use the full size JPEG preview Canon embeds in CR2 files rather than decoding the raw sensor data. Only the IFD
+    headers and the preview itself are read from disk.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        previews, orientation = find_tiff_jpegs(buf)
+        if not previews:
+            raise Exception("No embedded preview in {}".format(path))
+        offset, length = max(previews, key=lambda preview: preview[1])
+        image = Image.open(BytesIO(buf[offset:offset + length]))
+    # previews carry no exif of their own, apply the raw's orientation tag here
+    return image.rotate({3: 180, 6: 270, 8: 90}.get(orientation, 0), expand=True)
@@ -0,0 +1,79 @@
+import logging
+import threading
+from heapq import heappush, heappop
+from itertools import count
+from collections import namedtuple
+from photoapp.metrics import Gauge
+
+
+"""
+Background thumbnail generation. Request threads queue cache misses here and return straight away instead of waiting
+on a decode and resize, so a burst of cold thumbnails can't tie up the server's thread pool.
+"""
+
+# the fields of a Photo that make_thumb() reads, copied so jobs don't hold on to a request's database session
+ThumbSource = namedtuple("ThumbSource", "uuid format path orientation")
+
+# lower goes first: small tiles fill whole pages of the ui, large styles are viewed one at a time
+STYLE_PRIORITY = {"tiny": 0, "small": 0, "feed": 1, "preview": 2, "big": 3}
+
+THUMB_QUEUE = Gauge("photoapp_thumb_queue", "Thumbnails waiting to be generated or in progress")
+
+
+class ThumbnailQueue(object):
+    """
+    Priority queue of thumbnails to generate, worked by a fixed number of threads. Within a priority the most recently
+    requested thumbnail goes first, as it's most likely to still be on someone's screen. Requesting a thumbnail that is
+    already queued moves it up rather than adding it twice.
+    :param workers: thumbnails generated at once
+    :param max_pending: distinct thumbnails that may be queued, further requests are turned away
+    """
+    def __init__(self, library, workers=2, max_pending=1000):
+        self.library = library
+        self.max_pending = max_pending
+        self.heap = []
+        self.pending = {}  # (uuid, style) -> Event set once generation finishes
+        self.running = set()
+        self.seq = count()
+        self.cond = threading.Condition()
+        self.workers = [threading.Thread(target=self.work, daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, photo, style):
+        """
+        Queue generation of a thumbnail
+        :param photo: Photo or ThumbSource
+        :return: Event set once the thumbnail has been generated or has failed, or None if the queue is full
+        """
+        key = (photo.uuid, style)
+        with self.cond:
+            done = self.pending.get(key)
+            if done is None:
+                if len(self.pending) >= self.max_pending:
+                    return None
+                done = self.pending[key] = threading.Event()
+                THUMB_QUEUE.set(len(self.pending))
+            source = ThumbSource(photo.uuid, photo.format, photo.path, photo.orientation)
+            heappush(self.heap, (STYLE_PRIORITY.get(style, len(STYLE_PRIORITY)), -next(self.seq), key, source))
+            self.cond.notify()
+            return done
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                priority, seq, key, source = heappop(self.heap)
+                if key not in self.pending or key in self.running:
+                    continue  # an older entry for a thumbnail that was re-requested
+                self.running.add(key)
+            try:
+                self.library.make_thumb(source, key[1])
+            except Exception:
+                logging.exception("thumbnail generation failed: %s %s", *key)
+            finally:
+                with self.cond:
+                    self.running.discard(key)
+                    self.pending.pop(key).set()
+                    THUMB_QUEUE.set(len(self.pending))
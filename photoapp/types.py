@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Unicode, DECIMAL, ForeignKey, Boolean, Enum
+from sqlalchemy import Column, Integer, String, DateTime, Unicode, DECIMAL, ForeignKey, Boolean, Enum, Float
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
@@ -21,7 +21,7 @@ class PhotoSet(Base):
 
     id = Column(Integer, primary_key=True)
     uuid = Column(Unicode, unique=True, default=lambda: str(uuid.uuid4()))
-    date = Column(DateTime)
+    date = Column(DateTime, index=True)
     date_real = Column(DateTime)
     date_offset = Column(Integer, default=0)  # minutes
     lat = Column(DECIMAL(precision=11))
@@ -52,7 +52,26 @@ class Photo(Base):
     orientation = Column(Integer, default=0)
     hash = Column(String(length=64), unique=True)
     path = Column(Unicode)
+    name = Column(Unicode)  # original file name, set in content addressed libraries where the path is the hash
     format = Column(String(length=64))  # TODO how long can a mime string be
+    phash = Column(Integer)  # 64 bit perceptual hash stored as signed, see photoapp.dupes
+    camera_make = Column(String)
+    camera_model = Column(String, index=True)
+    # exposure details, see photoapp.exif
+    lens_model = Column(String, index=True)
+    focal_length = Column(Float, index=True)  # mm
+    iso = Column(Integer, index=True)
+    exposure_time = Column(Float)  # seconds
+    f_number = Column(Float)
+
+
+class FileVerification(Base):
+    # outcome of the most recent integrity check of a file, see photoapp.validate
+    __tablename__ = 'file_verifications'
+
+    file_id = Column(Integer, ForeignKey("files.id"), primary_key=True)
+    verified = Column(DateTime, index=True)
+    result = Column(String)  # "ok", "missing", "mismatch" or "error: ..."
 
 
 class Tag(Base):
@@ -86,7 +105,7 @@ class TagItem(Base):
     tag = relationship("Tag", back_populates="entries", foreign_keys=[tag_id])
     set = relationship("PhotoSet", back_populates="tags", foreign_keys=[set_id])
 
-    UniqueConstraint(tag_id, set_id)
+    __table_args__ = (UniqueConstraint(tag_id, set_id), )
 
 
 class UserStatus(enum.Enum):
@@ -1,27 +1,247 @@
+import os
+import re
+import json
 import argparse
+from time import time
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func, or_, and_
 from photoapp.library import PhotoLibrary
 from photoapp.image import get_hash
-from photoapp.types import Photo
-import os
+from photoapp.types import Photo, FileVerification
+from photoapp.common import bounded_map
 
 
-def validate_all(library):
+def iter_files(library, after=None, chunk=1000):
+    """
+    Yield (id, path, hash, size) of every file in the library in path order, which roughly matches on-disk locality.
+    Rows are fetched in chunks using the last (path, id) seen as the cursor, so the table is never loaded in full. Paths
+    aren't unique, the id keeps rows sharing a path from being skipped at a chunk boundary.
+    :param after: resume after this (path, id)
+    """
+    s = library.session()
+    while True:
+        query = s.query(Photo.id, Photo.path, Photo.hash, Photo.size)
+        if after is not None:
+            query = query.filter(or_(Photo.path > after[0], and_(Photo.path == after[0], Photo.id > after[1])))
+        rows = query.order_by(Photo.path, Photo.id).limit(chunk).all()
+        if not rows:
+            break
+        yield from rows
+        after = rows[-1][1], rows[-1][0]
+    s.close()
+
 
-    total = 0
+def iter_stale(library, older_than, chunk=1000):
+    """
+    Yield (id, path, hash, size) of files not verified since `older_than`, never-verified files first and then the
+    longest since verification. Each chunk is re-sorted by path before being handed out to keep reads local.
+    """
     s = library.session()
-    for item in s.query(Photo).order_by(Photo.date).all():
-        assert item.hash == get_hash(os.path.join(library.path, item.path))
-        print("ok ", item.path)
-        total += 1
-    print(total, "images verified")
+    verified = func.coalesce(FileVerification.verified, datetime.min)
+    after = None
+    while True:
+        query = s.query(Photo.id, Photo.path, Photo.hash, Photo.size, verified). \
+            outerjoin(FileVerification, FileVerification.file_id == Photo.id). \
+            filter(verified < older_than)
+        if after is not None:
+            query = query.filter(or_(verified > after[0], and_(verified == after[0], Photo.id > after[1])))
+        rows = query.order_by(verified, Photo.id).limit(chunk).all()
+        if not rows:
+            break
+        after = rows[-1][4], rows[-1][0]
+        yield from sorted((row[0:4] for row in rows), key=lambda row: row[1])
+    s.close()
+
+
+def check_file(args):
+    """
+    Verify one file against its recorded hash. Runs in a worker process.
+    :return: tuple of (id, path, status, size) where status is one of "ok", "missing", "mismatch" or "error: ..."
+    """
+    library_path, fid, path, expected, size, rate = args
+    fpath = os.path.join(library_path, path)
+    if not os.path.exists(fpath):
+        return fid, path, "missing", 0
+    try:
+        return fid, path, "ok" if get_hash(fpath, rate) == expected else "mismatch", size or 0
+    except OSError as e:
+        return fid, path, "error: {}".format(e), 0
+
+
+class Progress(object):
+    """
+    Checkpoint file recording how far through the library a verification run got. Files are checked in path order
+    and results consumed in that same order, so every file up to and including `last`, a [path, id] pair, has been
+    verified.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.last = None
+        self.checked = 0
+        self.problems = 0
+        self.saved = time()
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.last, self.checked, self.problems = state["last"], state["checked"], state["problems"]
+            if isinstance(self.last, str):  # checkpoints from before ids were recorded
+                self.last = [self.last, 0]
+
+    def save(self, force=False):
+        if not self.path or (not force and time() - self.saved < 10):
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"last": self.last, "checked": self.checked, "problems": self.problems}, f)
+        os.replace(self.path + ".tmp", self.path)
+        self.saved = time()
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def run_checks(library, rows, workers=None, readahead=4, bwlimit=None, batch=500):
+    """
+    Hash the given files across a process pool, recording each outcome in the file_verifications table, and yield
+    (id, path, status, size) results in input order. Problems are printed as they are found and don't stop the run.
+    :param rows: iterable of (id, path, hash, size)
+    :param workers: number of hashing processes, defaults to the cpu count
+    :param readahead: files queued per worker ahead of the results being consumed
+    :param bwlimit: total read bandwidth cap in bytes per second, split evenly across workers
+    """
+    workers = workers or os.cpu_count()
+    rate = bwlimit / workers if bwlimit else None
+    record = FileVerification.__table__.insert().prefix_with("OR REPLACE")
+    results = []
+
+    def flush():
+        if results:
+            library.engine.execute(record, results)
+            results.clear()
+
+    start = time()
+    nbytes = 0
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = ((library.path, fid, path, fhash, size, rate) for fid, path, fhash, size in rows)
+        try:
+            for done, (fid, path, status, size) in enumerate(bounded_map(pool, check_file, jobs, workers * readahead),
+                                                             start=1):
+                if status != "ok":
+                    print("{:<9}{}".format(status, path))
+                results.append({"file_id": fid, "verified": datetime.now(), "result": status})
+                if len(results) >= batch:
+                    flush()
+                nbytes += size
+                if done % 100 == 0:
+                    elapsed = time() - start
+                    print("  complete: {} - {:.1f} files/s {:.1f} MB/s\r".format(
+                        done, done / elapsed, nbytes / elapsed / 1024 / 1024), end='')
+                yield fid, path, status, size
+        finally:
+            flush()
+
+
+def validate_all(library, progress_path=None, **kwargs):
+    """
+    Re-hash every file in the library and compare against the database. See run_checks() for options.
+    :param progress_path: checkpoint file; an interrupted run picks up where it left off
+    :return: number of problems found
+    """
+    progress = Progress(progress_path)
+    progress.load()
+    if progress.last:
+        print("Resuming after {} ({} already checked)".format(progress.last[0], progress.checked))
+
+    try:
+        for fid, path, status, size in run_checks(library, iter_files(library, progress.last), **kwargs):
+            if status != "ok":
+                progress.problems += 1
+            progress.checked += 1
+            progress.last = [path, fid]
+            progress.save()
+    except KeyboardInterrupt:
+        progress.save(force=True)
+        raise
+
+    print("\n{} files verified, {} problems".format(progress.checked, progress.problems))
+    problems = progress.problems
+    progress.clear()
+    return problems
+
+
+def validate_stale(library, older_than, max_seconds=None, max_bytes=None, **kwargs):
+    """
+    Verify files that haven't been checked since `older_than`, stalest first, until the time or byte budget runs out.
+    Run regularly, this scrubs the whole library on a rolling schedule at a steady I/O cost.
+    :param max_seconds: stop queueing files after this long
+    :param max_bytes: stop queueing files once this many bytes have been queued
+    :return: number of problems found
+    """
+    start = time()
+    queued = 0
+
+    def budgeted(rows):
+        nonlocal queued
+        for row in rows:
+            if (max_seconds and time() - start > max_seconds) or (max_bytes and queued >= max_bytes):
+                print("\nBudget exhausted")
+                return
+            queued += row[3] or 0
+            yield row
+
+    checked = problems = 0
+    for fid, path, status, size in run_checks(library, budgeted(iter_stale(library, older_than)), **kwargs):
+        checked += 1
+        problems += 0 if status == "ok" else 1
+    print("\n{} files verified, {} problems".format(checked, problems))
+    return problems
+
+
+def parse_quantity(value, units):
+    """
+    Parse strings like "2h" or "500G" given a dict of lowercase unit suffix to multiplier
+    """
+    match = re.match(r'^(\d+(?:\.\d+)?)([a-zA-Z]?)$', value.strip())
+    if not match or match.group(2).lower() not in units:
+        raise argparse.ArgumentTypeError("invalid value: {}".format(value))
+    return float(match.group(1)) * units[match.group(2).lower()]
+
+
+def parse_duration(value):
+    return parse_quantity(value, {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800})
+
+
+def parse_size(value):
+    return parse_quantity(value, {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4})
 
 
 def main():
     parser = argparse.ArgumentParser(description="Library verification tool")
-    parser.parse_args()
-    library = PhotoLibrary("photos.db", "./library/")
-    validate_all(library)
+    parser.add_argument("-j", "--workers", type=int, help="hashing processes, defaults to the cpu count")
+    parser.add_argument("--bwlimit", type=float, help="max total read rate in MB/s")
+    parser.add_argument("--progress", default="./cache/validate.json", help="checkpoint file used to resume runs")
+    parser.add_argument("--restart", action="store_true", help="ignore any checkpoint and verify from the start")
+    parser.add_argument("--older-than", type=parse_duration,
+                        help="incremental mode: only verify files not checked within this long, e.g. 30d")
+    parser.add_argument("--budget", type=parse_duration, help="incremental mode: time to spend, e.g. 2h")
+    parser.add_argument("--budget-bytes", type=parse_size, help="incremental mode: data to read, e.g. 500G")
+    args = parser.parse_args()
+    library = PhotoLibrary("photos.db", "./library/", "./cache/")
+    options = dict(workers=args.workers, bwlimit=args.bwlimit * 1024 * 1024 if args.bwlimit else None)
+
+    if args.older_than is not None or args.budget or args.budget_bytes:
+        problems = validate_stale(library, datetime.now() - timedelta(seconds=args.older_than or 0),
+                                  max_seconds=args.budget, max_bytes=args.budget_bytes, **options)
+    else:
+        if args.restart and os.path.exists(args.progress):
+            os.unlink(args.progress)
+        problems = validate_all(library, progress_path=args.progress, **options)
+    return 1 if problems else 0
 
 
 if __name__ == '__main__':
-    main()
+    exit(main())
@@ -12,7 +12,7 @@ setup(name='photoapp',
       url='',
       author='dpedu',
       author_email='dave@davepedu.com',
-      packages=['photoapp'],
+      packages=['photoapp', 'photoapp.bench'],
       install_requires=[],
       entry_points={
           "console_scripts": [
@@ -22,6 +22,11 @@ setup(name='photoapp',
               "photoinfo = photoapp.image:main",
               "photooffset = photoapp.dateoffset:main",
               "photousers = photoapp.users:main",
+              "photodupes = photoapp.dupes:main",
+              "photoreconcile = photoapp.reconcile:main",
+              "photoexif = photoapp.exif:main",
+              "photobench = photoapp.bench.run:main",
+              "photostore = photoapp.store:main",
           ]
       },
       include_package_data=True,
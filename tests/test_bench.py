@@ -0,0 +1,21 @@
+from photoapp.bench.run import summarize, time_thumbs
+
+
+def test_summarize_percentiles():
+    stats = summarize([0.004, 0.001, 0.003, 0.002])
+    assert stats["n"] == 4
+    assert stats["p50_ms"] == 2.5
+    assert stats["p95_ms"] == 3.85
+    assert stats["max_ms"] == 4
+    assert summarize([]) == {"n": 0}
+
+
+class Library(object):
+    def make_thumb(self, photo, style):
+        return "/thumbs/{}.jpg".format(photo) if photo % 2 else None
+
+
+def test_failed_thumbs_are_errors():
+    stats = time_thumbs(Library(), [1, 2, 3, 4, 5], "feed")
+    assert stats["n"] == 3
+    assert stats["errors"] == 2
@@ -0,0 +1,15 @@
+from PIL import Image
+from photoapp.image import get_jpg_info
+
+
+def test_truncated_jpeg_imports_without_phash(tmp_path):
+    path = tmp_path / "full.jpg"
+    Image.effect_noise((800, 600), 50).convert("RGB").save(str(path), quality=95)
+    data = path.read_bytes()
+    truncated = tmp_path / "truncated.jpg"
+    truncated.write_bytes(data[:len(data) // 3])
+
+    assert get_jpg_info(str(path)).files[0].phash is not None
+    photo = get_jpg_info(str(truncated)).files[0]
+    assert photo.phash is None
+    assert (photo.width, photo.height) == (800, 600)
@@ -0,0 +1,20 @@
+import os
+from datetime import datetime
+from photoapp.library import PhotoLibrary
+from photoapp.types import Photo, PhotoSet
+
+
+def test_set_offset_skips_files_it_cannot_move(tmp_path):
+    library = PhotoLibrary(str(tmp_path / "photos.db"), str(tmp_path / "library"), str(tmp_path / "cache"))
+    os.makedirs(os.path.join(library.path, "2018/1/1"))
+    open(os.path.join(library.path, "2018/1/1/a.jpg"), "wb").close()
+    s = library.session()
+    s.add(PhotoSet(date=datetime(2018, 1, 1, 23), date_real=datetime(2018, 1, 1, 23), lat=0, lon=0,
+                   files=[Photo(path="2018/1/1/a.jpg", format="image/jpeg", size=0, hash="a"),
+                          Photo(path="2018/1/1/gone.jpg", format="image/jpeg", size=0, hash="b")]))
+    s.commit()
+
+    moved, skipped = library.set_offset(s, s.query(PhotoSet.id), 120)
+    assert (moved, skipped) == (1, ["2018/1/1/gone.jpg"])
+    assert sorted(path for path, in s.query(Photo.path)) == ["2018/1/1/gone.jpg", "2018/1/2/a.jpg"]
+    assert os.path.exists(os.path.join(library.path, "2018/1/2/a.jpg"))
@@ -0,0 +1,18 @@
+import os
+from datetime import datetime
+from photoapp.library import PhotoLibrary
+from photoapp.reconcile import reconcile
+from photoapp.types import Photo, PhotoSet
+
+
+def test_duplicates_across_chunks(tmp_path):
+    library = PhotoLibrary(str(tmp_path / "photos.db"), str(tmp_path / "library"), str(tmp_path / "cache"))
+    os.makedirs(str(tmp_path / "library" / "2019" / "1" / "1"))
+    (tmp_path / "library" / "2019" / "1" / "1" / "a.jpg").write_bytes(b"a")
+    s = library.session()
+    for i in range(5):
+        s.add(PhotoSet(date=datetime(2019, 1, 1), date_real=datetime(2019, 1, 1),
+                       files=[Photo(path="2019/1/1/a.jpg", hash=str(i), size=1)]))
+    s.commit()
+    # the 5 rows sharing a path are split over 3 chunks
+    assert list(reconcile(library, chunk=2)) == [("duplicate", "2019/1/1/a.jpg", None)] * 4
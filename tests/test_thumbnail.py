@@ -0,0 +1,55 @@
+import io
+import struct
+from PIL import Image
+from photoapp.bench.fixtures import ifd, make_image, SHORT, LONG
+from photoapp.thumbnail import find_tiff_jpegs, load_raw_preview
+
+
+def jpeg(size):
+    buf = io.BytesIO()
+    make_image(size, 1).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+# sensor data as canon stores it: a lossless (SOF3) 14 bit jpeg, and by far the largest region in the file
+LOSSLESS = b"\xff\xd8" + b"\xff\xc4\x00\x04\x00\x00" + \
+    b"\xff\xc3\x00\x0b\x0e\x00\x20\x00\x20\x01\x01\x11\x00" + b"\xff\xda\x00\x08\x01\x01\x00\x00\x00\x00" + \
+    bytes(200000) + b"\xff\xd9"
+
+
+def cr2(orientation=1):
+    """
+    Lay a file out like a CR2: the tiff header followed by canon's "CR" header pointing at the raw IFD, then
+    IFD0 with the full size preview as its strip, IFD1 with a JPEGInterchangeFormat thumbnail, IFD2 with an
+    uncompressed RGB strip and IFD3 with the lossless sensor data
+    """
+    preview, thumb, rgb = jpeg((320, 240)), jpeg((160, 120)), bytes(64 * 48 * 3)
+    layouts = [lambda offset: [(0x0103, SHORT, [6]), (0x0111, LONG, [offset]), (0x0112, SHORT, [orientation]),
+                               (0x0117, LONG, [len(preview)])],
+               lambda offset: [(0x0201, LONG, [offset]), (0x0202, LONG, [len(thumb)])],
+               lambda offset: [(0x0103, SHORT, [1]), (0x0111, LONG, [offset]), (0x0117, LONG, [len(rgb)])],
+               lambda offset: [(0x0103, SHORT, [6]), (0x0111, LONG, [offset]), (0x0117, LONG, [len(LOSSLESS)])]]
+    payloads = [preview, thumb, rgb, LOSSLESS]
+    sizes = [len(ifd(layout(0), 0)) for layout in layouts]
+    ifd_offsets = [16 + sum(sizes[:i]) for i in range(4)]
+    data_offsets = [16 + sum(sizes) + sum(len(p) for p in payloads[:i]) for i in range(4)]
+    data = b"II*\0" + struct.pack("<L", 16) + b"CR\x02\x00" + struct.pack("<L", ifd_offsets[3])
+    for i, layout in enumerate(layouts):
+        data += ifd(layout(data_offsets[i]), ifd_offsets[i], ifd_offsets[i + 1] if i < 3 else 0)
+    return data + b"".join(payloads), data_offsets
+
+
+def test_cr2_previews_skip_sensor_data():
+    data, offsets = cr2()
+    previews, orientation = find_tiff_jpegs(data)
+    assert sorted(previews) == sorted([(offsets[0], len(jpeg((320, 240)))), (offsets[1], len(jpeg((160, 120))))])
+    assert orientation == 1
+
+
+def test_cr2_loads_full_size_preview(tmp_path):
+    data, offsets = cr2(orientation=6)
+    path = tmp_path / "IMG_0001.CR2"
+    path.write_bytes(data)
+    image = load_raw_preview(str(path))
+    assert isinstance(image, Image.Image)
+    assert image.size == (240, 320)  # rotated upright